@@ -0,0 +1,101 @@
+# utilities
+import os
+import csv
+import glob
+import json
+import time
+import argparse
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+# repository
+from pipeline import add_arguments, run, option_actions, apply_options
+
+TIMELAPSE_EXTENSIONS = ('.dv', '.tiff', '.tif')
+
+# Input Collection
+# pipeline outputs are written next to their input as `{filename}_*`
+def is_timelapse(filename):
+    name = os.path.basename(filename).lower()
+    return name.endswith(TIMELAPSE_EXTENSIONS) and not any(f'{extension}_' in name for extension in TIMELAPSE_EXTENSIONS)
+
+# expands directories, glob patterns and CSV/JSON manifests into (filename, overrides) jobs
+def collect_jobs(inputs):
+    jobs = []
+    for source in inputs:
+        if(os.path.isdir(source)):
+            for filename in sorted(os.listdir(source)):
+                if(is_timelapse(filename)): jobs.append((os.path.join(source, filename), {}))
+        elif(source.lower().endswith('.csv')):
+            with open(source, newline='') as manifest:
+                for row in csv.DictReader(manifest):
+                    filename = row.pop('filename')
+                    jobs.append((filename, {key: value for key, value in row.items() if value not in (None, '')}))
+        elif(source.lower().endswith('.json')):
+            with open(source) as manifest:
+                entries = json.load(manifest)
+            for entry in entries:
+                entry = dict(entry)
+                jobs.append((entry.pop('filename'), entry))
+        else:
+            matches = [filename for filename in sorted(glob.glob(source)) if is_timelapse(filename)]
+            if(len(matches) == 0): raise Exception(f'No timelapse matches {source}.')
+            for filename in matches: jobs.append((filename, {}))
+
+    return jobs
+
+# Per-File Arguments
+# applies the manifest overrides of a single file over the batch defaults
+def file_arguments(defaults, actions, filename, overrides):
+    args = argparse.Namespace(**vars(defaults))
+    args.filename = filename
+    return apply_options(args, actions, overrides)
+
+# Runs the pipeline on a single file, failures are reported instead of raised
+def run_file(args):
+    ts = time.time()
+    try:
+        run(args)
+        status, error = 'ok', ''
+    except Exception as exception:
+        traceback.print_exc()
+        status, error = 'failed', f'{type(exception).__name__}: {exception}'
+
+    return {'filename': args.filename, 'status': status, 'seconds': round(time.time() - ts, 3), 'error': error}
+
+# writes one row per file with its status and timing
+def write_summary(results, summary_filename):
+    with open(summary_filename, 'w', newline='') as summary:
+        writer = csv.DictWriter(summary, fieldnames=['filename', 'status', 'seconds', 'error'])
+        writer.writeheader()
+        writer.writerows(results)
+
+if __name__ == "__main__":
+    # execution time
+    ts = time.time()
+    print(f'[timestamp] {ts}')
+
+    # Argument Parsing
+    parser = argparse.ArgumentParser(description='AMEBaS batch mode: runs the pipeline over many timelapses in one invocation. Pipeline options are used as defaults for every file.')
+    parser.add_argument('inputs', type=str, nargs='+', metavar='input', help='Directory, glob pattern or CSV/JSON manifest. Manifests have a `filename` column/key and optional per-file pipeline options (e.g. sigma, f, sf).')
+    parser.add_argument("--jobs", type=int, nargs="?", default=1, help='Number of files processed concurrently. Default is 1.')
+    parser.add_argument("--summary", type=str, nargs="?", default='batch_summary.csv', help='Filename of the summary table with per-file status and timings. Default is batch_summary.csv.')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    # per-file arguments
+    defaults = argparse.Namespace(**{key: value for key, value in vars(args).items() if key not in ('inputs', 'jobs', 'summary')})
+    actions = option_actions(parser)
+    jobs = [file_arguments(defaults, actions, filename, overrides) for filename, overrides in collect_jobs(args.inputs)]
+    print(f'[batch] {len(jobs)} files, {args.jobs} concurrent')
+
+    # execution: each worker process imports the pipeline once and reuses it for many files
+    if(args.jobs > 1):
+        with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            results = list(executor.map(run_file, jobs))
+    else:
+        results = [run_file(job) for job in jobs]
+
+    write_summary(results, args.summary)
+    n_failed = sum(result['status'] != 'ok' for result in results)
+    print(f'[batch] {len(results) - n_failed} succeeded, {n_failed} failed in {round(time.time() - ts, 3)}s, summary at {args.summary}')
@@ -0,0 +1,160 @@
+# utilities
+import os
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+
+# image processing
+from skimage import io
+from scipy.spatial import cKDTree
+
+# repository
+from processing import *
+from synthetic import synthetic_timelapse, DIRECTIONS
+from pipeline import build_parser, run
+
+# Benchmark Suite
+# times every processing function and the end-to-end pipeline on synthetic timelapses
+# and checks the traced midline, growth direction and kymograph against the generator ground truth
+
+# best wall time over `repeat` calls, `prepare` builds fresh arguments for functions that modify their inputs
+def best_time(function, args, repeat, prepare=None):
+    best, result = np.inf, None
+    for _ in range(repeat):
+        call_args = prepare(args) if prepare is not None else args
+        ts = time.perf_counter()
+        result = function(*call_args)
+        best = min(best, time.perf_counter() - ts)
+    return best, result
+
+def benchmark_processing(data, repeat, workers):
+    timelapse = data['timelapse']
+    two_channels = timelapse.ndim == 4
+    c_1 = timelapse[:,-1] if two_channels else timelapse
+    timings = {}
+
+    if(two_channels): timings['median_stream'], median_c_0 = best_time(median_stream, (timelapse[:,0], timelapse.shape[0]), repeat)
+    timings['segmentation_stream'], (median_c_1, _, mask_c_1, thresh_c_1) = best_time(segmentation_stream, (c_1, 2, c_1.shape[0], 40, False, False, '.', 'benchmark', workers, None, False, np.float32), repeat)
+    timings['thresholding'], _ = best_time(thresholding, (img_as_float32(median_c_1), 40, False, False, '.', 'benchmark', workers), repeat)
+    timings['isolate_largest_area'], (mask_c_1, signal_c_1) = best_time(isolate_largest_area, (mask_c_1, workers), repeat, lambda args: (args[0].copy(), args[1]))
+    timings['skeletonize_all_frames'], (skeleton_timelapse, skeleton_coordinates) = best_time(skeletonize_all_frames, (mask_c_1, workers), repeat)
+    timings['skeletonization'], (skeleton, skeleton_object) = best_time(skeletonization, (mask_c_1[-1],), repeat)
+    first_skeleton, first_skeleton_object = skeletonization(mask_c_1[0])
+    timings['get_growth_direction'], (angle, coordinates, growing_forward) = best_time(get_growth_direction, (first_skeleton_object, skeleton_object), repeat)
+    timings['extrapolate'], _ = best_time(extrapolate, (skeleton.shape, int(coordinates.shape[0] * .25), -1, angle, coordinates, growing_forward), repeat)
+    timings['kymograph'], kymograph_c_1 = best_time(kymograph, (median_c_1, skeleton_object.coordinates, 3, growing_forward), repeat)
+    timings['kymograph_framewise'], _ = best_time(kymograph_framewise, (median_c_1, skeleton_coordinates, 3, growing_forward), repeat)
+    if(two_channels):
+        ratiometric_args = (median_c_0, median_c_1, signal_c_1, mask_c_1, thresh_c_1, False, True, False)
+        timings['ratiometric'], _ = best_time(ratiometric, ratiometric_args, repeat)
+        timings['ratiometric_vectorized'], _ = best_time(ratiometric_vectorized, ratiometric_args, repeat)
+        timings['masked_foreground'], _ = best_time(masked_foreground, (median_c_0.astype(np.float32), mask_c_1), repeat, lambda args: (args[0].copy(), args[1]))
+
+    return timings, check_correctness(data, skeleton_object, growing_forward, kymograph_c_1)
+
+# Correctness Checks
+def check_correctness(data, skeleton_object, growing_forward, kymograph_c_1):
+    midline = data['midlines'][-1] # ground truth of the last frame, base -> tip
+    traced = skeleton_object.coordinates
+
+    # mean distance between the traced skeleton and the true midline, in both directions
+    traced_error = cKDTree(midline).query(traced)[0].mean()
+    coverage_error = cKDTree(traced).query(midline)[0].mean()
+
+    # kymograph of the last frame against the noise-free intensity along the true midline, base -> tip
+    clean = data['clean'][-1, -1] if data['clean'].ndim == 4 else data['clean'][-1]
+    expected = clean[midline[:,0], midline[:,1]]
+    measured = kymograph_c_1[-1]
+    samples = np.linspace(0, 1, 64)
+    expected = np.interp(samples, np.linspace(0, 1, expected.shape[0]), expected)
+    measured = np.interp(samples, np.linspace(0, 1, measured.shape[0]), measured)
+
+    return {'midline_error_px': float(max(traced_error, coverage_error)),
+            'growth_direction_ok': bool(growing_forward == data['growing_forward']),
+            'kymograph_relative_error': float(np.abs(measured - expected).mean() / expected.mean())}
+
+# End-to-End Benchmark
+# runs the command line pipeline on the synthetic timelapse and reads back its stage report
+def benchmark_pipeline(data, repeat, pipeline_args):
+    best, report = np.inf, None
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'synthetic.tiff')
+        io.imsave(filename, data['timelapse'], check_contrast=False)
+        for _ in range(repeat):
+            args = build_parser().parse_args([filename, '--report', os.path.join(directory, 'report.json')] + pipeline_args)
+            ts = time.perf_counter()
+            run(args)
+            seconds = time.perf_counter() - ts
+            if(seconds < best):
+                best = seconds
+                with open(os.path.join(directory, 'report.json')) as report_file: report = json.load(report_file)
+    return {'pipeline': best, **{f"stage:{stage['stage']}": stage['wall_seconds'] for stage in report['stages']}}
+
+# Results
+def git_commit():
+    repository = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=repository, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=repository, capture_output=True, text=True).stdout.strip()
+        return f'{commit}-dirty' if dirty else commit
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+# prints the timing ratio of every case and function against a stored run, flags slowdowns above `tolerance`
+def compare_results(results, reference, tolerance):
+    n_regressions = 0
+    for case, timings in results['cases'].items():
+        if(case not in reference['cases']): continue
+        for name, seconds in timings['timings'].items():
+            reference_seconds = reference['cases'][case]['timings'].get(name)
+            if(not reference_seconds): continue
+            ratio = seconds / reference_seconds
+            flag = ' REGRESSION' if ratio > 1 + tolerance else ''
+            n_regressions += bool(flag)
+            print(f'{case:<28} {name:<32} {reference_seconds:10.4f}s -> {seconds:10.4f}s  x{ratio:5.2f}{flag}')
+    return n_regressions
+
+if __name__ == "__main__":
+    # Argument Parsing
+    parser = argparse.ArgumentParser(description='AMEBaS benchmark suite on synthetic growing tube timelapses.')
+    parser.add_argument("--frames", type=int, nargs="+", default=[20, 60], help='Frame counts of the synthetic timelapses. Default is 20 60.')
+    parser.add_argument("--sizes", type=str, nargs="+", default=['128x192', '256x384'], help='Frame sizes as YxX. Default is 128x192 256x384.')
+    parser.add_argument("--directions", type=str, nargs="+", choices=DIRECTIONS, default=list(DIRECTIONS), help='Growth directions. Default is all.')
+    parser.add_argument("--channels", type=int, choices=[1, 2], default=2, help='Number of channels. Default is 2.')
+    parser.add_argument("--noise", type=float, nargs="?", default=20., help='Standard deviation of the gaussian noise. Default is 20.')
+    parser.add_argument("--repeat", type=int, nargs="?", default=3, help='Timed repetitions, the best is kept. Default is 3.')
+    parser.add_argument("--workers", type=int, nargs="?", default=1, help='Workers of the per-frame stages. Default is 1.')
+    parser.add_argument("--end_to_end", default=False, action='store_true', help='Also times the command line pipeline. Default is false.')
+    parser.add_argument("--output", type=str, nargs="?", default='benchmarks', help='Directory where results are stored as <commit>.json. Default is benchmarks.')
+    parser.add_argument("--compare", type=str, nargs="?", default=None, help='Commit (or results file) to compare against.')
+    parser.add_argument("--tolerance", type=float, nargs="?", default=.2, help='Relative slowdown reported as a regression. Default is 0.2.')
+    args = parser.parse_args()
+
+    results = {'commit': git_commit(), 'timestamp': time.time(), 'cases': {}}
+    failed_checks = []
+    for size in args.sizes:
+        shape = tuple(int(side) for side in size.split('x'))
+        for n_frames in args.frames:
+            for direction in args.directions:
+                case = f'{direction}-{n_frames}f-{size}'
+                data = synthetic_timelapse(n_frames, shape, args.channels, args.noise, direction)
+                timings, checks = benchmark_processing(data, args.repeat, args.workers)
+                if(args.end_to_end): timings.update(benchmark_pipeline(data, args.repeat, ['--o']))
+                results['cases'][case] = {'timings': timings, 'checks': checks}
+                print(f'[{case}]', ', '.join(f'{name} {seconds:.4f}s' for name, seconds in timings.items()))
+                print(f'[{case}]', checks)
+                if(not checks['growth_direction_ok'] or checks['midline_error_px'] > 2 or checks['kymograph_relative_error'] > .1): failed_checks.append(case)
+
+    os.makedirs(args.output, exist_ok=True)
+    output_filename = os.path.join(args.output, f"{results['commit']}.json")
+    with open(output_filename, 'w') as output: json.dump(results, output, indent=2)
+    print(f'[benchmark] results at {output_filename}')
+    if(len(failed_checks) > 0): print('[benchmark] ground truth checks failed:', ', '.join(failed_checks))
+
+    if(args.compare is not None):
+        reference_filename = args.compare if args.compare.endswith('.json') else os.path.join(args.output, f'{args.compare}.json')
+        with open(reference_filename) as reference: n_regressions = compare_results(results, json.load(reference), args.tolerance)
+        print(f'[benchmark] {n_regressions} regressions against {reference_filename}')
@@ -0,0 +1,114 @@
+# Imports
+# utilities
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+
+# repository
+from processing import RegionIndex, SkeletonCoordinates
+
+# Stage Cache
+# content-addressed on-disk cache of pipeline stage results
+# each entry is keyed by the input file hash, the stage parameters, the keys of the stages it depends on
+# and the code version, so changing an argument only invalidates the stages downstream of it
+# entries are directories of .npy files, loaded memory-mapped and copy-on-write
+HASH_BLOCK = 16 * 2**20
+
+# modules whose code determines the stored results: processing functions, stage logic and parameters, readers and packing
+CODE_MODULES = ('processing.py', 'pipeline.py', 'reader.py', 'cache.py')
+
+def source_hash(filenames):
+    digest = hashlib.sha256()
+    for filename in filenames:
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), filename), 'rb') as source: digest.update(source.read())
+    return digest.hexdigest()
+
+CODE_VERSION = source_hash(CODE_MODULES)
+
+class StageCache:
+    # a cache without directory is disabled: nothing is stored and every lookup misses
+    def __init__(self, directory=None, max_size=2048):
+        self.directory = directory
+        self.max_size = max_size * 2**20 # megabytes
+        if(directory is not None): os.makedirs(directory, exist_ok=True)
+
+    # content hash of the input file, memoized by path, size and modification time
+    def input_key(self, filename):
+        if(self.directory is None): return None
+        stat = os.stat(filename)
+        memo_filename = os.path.join(self.directory, 'input_hashes.json')
+        memo_key = f'{os.path.abspath(filename)}:{stat.st_size}:{stat.st_mtime_ns}'
+        memo = {}
+        if(os.path.exists(memo_filename)):
+            with open(memo_filename) as memo_file: memo = json.load(memo_file)
+        if(memo_key not in memo):
+            digest = hashlib.sha256()
+            with open(filename, 'rb') as timelapse:
+                for block in iter(lambda: timelapse.read(HASH_BLOCK), b''): digest.update(block)
+            memo[memo_key] = digest.hexdigest()
+            with open(f'{memo_filename}.{os.getpid()}', 'w') as memo_file: json.dump(memo, memo_file)
+            os.replace(f'{memo_filename}.{os.getpid()}', memo_filename)
+        return memo[memo_key]
+
+    def key(self, stage, parents, params):
+        if(self.directory is None): return None
+        description = json.dumps([stage, parents, params, CODE_VERSION], sort_keys=True, default=str)
+        return f'{stage}-{hashlib.sha256(description.encode()).hexdigest()[:32]}'
+
+    # returns the arrays stored under `key`, or None on a miss
+    def load(self, key):
+        if(key is None): return None
+        entry = os.path.join(self.directory, key)
+        if(not os.path.isdir(entry)): return None
+        os.utime(entry) # least recently used entries are evicted first
+        arrays = {}
+        for filename in os.listdir(entry):
+            arrays[filename[:-len('.npy')]] = np.load(os.path.join(entry, filename), mmap_mode='c', allow_pickle=False)
+        return arrays
+
+    def store(self, key, arrays):
+        if(key is None): return
+        entry = os.path.join(self.directory, key)
+        staging = f'{entry}.{os.getpid()}.tmp'
+        os.makedirs(staging, exist_ok=True)
+        for name, array in arrays.items(): np.save(os.path.join(staging, f'{name}.npy'), np.asarray(array), allow_pickle=False)
+        try: os.rename(staging, entry) # atomic commit, concurrent writers of the same key produce the same content
+        except OSError: shutil.rmtree(staging, ignore_errors=True)
+        self.evict()
+
+    # removes least recently used entries until the cache fits its size cap
+    def evict(self):
+        entries = []
+        for key in os.listdir(self.directory):
+            entry = os.path.join(self.directory, key)
+            if(not os.path.isdir(entry) or key.endswith('.tmp')): continue
+            size = sum(os.path.getsize(os.path.join(entry, filename)) for filename in os.listdir(entry))
+            entries.append((os.path.getmtime(entry), size, entry))
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if(total <= self.max_size): break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+# Packing Helpers
+# per-frame regions are stored as their flat offset index, skeletons as concatenated arrays plus per-frame lengths
+# and whether each midline is in path order
+def pack_regions(regions):
+    return {'region_offsets': regions.offsets, 'region_bounds': regions.bounds, 'region_shape': np.array(regions.frame_shape)}
+
+def unpack_regions(arrays):
+    return RegionIndex(np.asarray(arrays['region_offsets']), np.asarray(arrays['region_bounds']), arrays['region_shape'].tolist())
+
+def pack_skeletons(skeletons):
+    return {'skeleton_coordinates': np.concatenate([skeleton.coordinates for skeleton in skeletons]).reshape(-1, 2),
+            'skeleton_degrees': np.concatenate([skeleton.degrees for skeleton in skeletons]),
+            'skeleton_lengths': np.array([skeleton.coordinates.shape[0] for skeleton in skeletons]),
+            'skeleton_ordered': np.array([getattr(skeleton, 'ordered', False) for skeleton in skeletons], dtype=bool)}
+
+def unpack_skeletons(arrays):
+    bounds = np.cumsum(arrays['skeleton_lengths'])[:-1]
+    coordinates = np.split(np.asarray(arrays['skeleton_coordinates']), bounds)
+    degrees = np.split(np.asarray(arrays['skeleton_degrees']), bounds)
+    return [SkeletonCoordinates(c, d, bool(o)) for c, d, o in zip(coordinates, degrees, arrays['skeleton_ordered'])]
@@ -0,0 +1,120 @@
+# Imports
+# utilities
+import time
+import json
+import resource
+import functools
+import contextlib
+
+# Instrumentation
+# records wall time, CPU time, memory high-water marks and counters of the pipeline stages and processing functions
+# the high-water marks are not per stage: `max_rss_mb` is the largest RSS of this process since it started and
+# `workers_max_rss_mb` the largest RSS of any worker process that exited so far
+# a disabled recorder does no bookkeeping: stages, counters and instrumented functions cost one attribute check
+class Recorder:
+    def __init__(self, enabled=False, profile=(), profiler='cprofile', prefix='amebas'):
+        self.enabled = enabled
+        self.profile = set(profile or ())
+        self.profiler = profiler
+        self.prefix = prefix
+        self.stages = []
+        self.functions = {}
+        self.counters = {}
+        self.started = time.time()
+
+    @contextlib.contextmanager
+    def stage(self, name, frames=None):
+        if(not self.enabled and name not in self.profile):
+            yield
+            return
+
+        counters, self.counters = self.counters, {} # counters of the enclosing stage
+        profiler = self.start_profiler() if name in self.profile else None
+        wall, cpu, children_cpu = time.perf_counter(), time.process_time(), children_cpu_time()
+        try:
+            yield
+        finally:
+            record = {'stage': name,
+                      'wall_seconds': time.perf_counter() - wall,
+                      'cpu_seconds': time.process_time() - cpu,
+                      'workers_cpu_seconds': children_cpu_time() - children_cpu,
+                      'max_rss_mb': max_rss_mb(),
+                      'workers_max_rss_mb': max_rss_mb(resource.RUSAGE_CHILDREN),
+                      'frames': frames,
+                      'counters': self.counters}
+            if(profiler is not None): record['profile'] = self.stop_profiler(profiler, name)
+            self.counters = counters
+            for counter, value in record['counters'].items(): self.count(counter, value) # propagates to the enclosing stage
+            if(self.enabled): self.stages.append(record)
+
+    def count(self, name, value=1):
+        if(self.enabled): self.counters[name] = self.counters.get(name, 0) + value
+
+    # Profiling Hooks
+    def start_profiler(self):
+        if(self.profiler == 'pyinstrument'):
+            from pyinstrument import Profiler # optional dependency
+            profiler = Profiler()
+            profiler.start()
+        else:
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.enable()
+        return profiler
+
+    def stop_profiler(self, profiler, name):
+        if(self.profiler == 'pyinstrument'):
+            profiler.stop()
+            filename = f'{self.prefix}_profile_{name}.html'
+            with open(filename, 'w') as output: output.write(profiler.output_html())
+        else:
+            profiler.disable()
+            filename = f'{self.prefix}_profile_{name}.prof' # readable with pstats or snakeviz
+            profiler.dump_stats(filename)
+        print(f'[profile] {name} -> {filename}')
+        return filename
+
+    # Report
+    def report(self, **metadata):
+        return {**metadata,
+                'wall_seconds': time.time() - self.started,
+                'max_rss_mb': max_rss_mb(),
+                'workers_max_rss_mb': max_rss_mb(resource.RUSAGE_CHILDREN),
+                'stages': self.stages,
+                'functions': self.functions}
+
+    def write(self, report_filename, **metadata):
+        with open(report_filename, 'w') as output: json.dump(self.report(**metadata), output, indent=2, default=str)
+
+def children_cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN) # worker processes, once they exit
+    return usage.ru_utime + usage.ru_stime
+
+def max_rss_mb(who=resource.RUSAGE_SELF):
+    return resource.getrusage(who).ru_maxrss / 1024. # kilobytes on Linux, the largest child for RUSAGE_CHILDREN
+
+# the active recorder, disabled unless the pipeline enables it
+recorder = Recorder()
+
+def activate(new_recorder):
+    global recorder
+    recorder = new_recorder
+    return recorder
+
+def count(name, value=1):
+    if(recorder.enabled): recorder.count(name, value)
+
+# aggregates calls, wall time and CPU time of a processing function
+def instrumented(function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if(not recorder.enabled): return function(*args, **kwargs)
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            record = recorder.functions.setdefault(function.__name__, {'calls': 0, 'wall_seconds': 0., 'cpu_seconds': 0.})
+            record['calls'] += 1
+            record['wall_seconds'] += time.perf_counter() - wall
+            record['cpu_seconds'] += time.process_time() - cpu
+    return wrapper
@@ -0,0 +1,214 @@
+# utilities
+import csv
+import time
+import argparse
+import traceback
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+# image processing
+from scipy import ndimage
+
+# repository
+# matplotlib, skan and loess are only imported by the features that use them, see pipeline.py
+from visualization import generate_cmap
+from processing import PRECISIONS, EIGHT_CONNECTIVITY, RegionIndex, SkeletonCoordinates, filter_halo, median_stream, segmentation_stream, \
+    skeletonize_all_frames, skeletonization, get_growth_direction, extend_skeleton, kymograph, kymograph_framewise, ratiometric_vectorized, \
+    masked_foreground
+from reader import read_timelapse, frame_chunk_size, allocate
+import instrumentation
+from instrumentation import Recorder
+from pipeline import add_arguments
+from writers import OutputWriter, check_dependencies
+
+# Multi-Cell Mode
+# segments the timelapse once, links the regions of consecutive frames into per-cell tracks and runs the midline,
+# kymograph and ratiometric stages of every track on its own crop, tracks are analyzed in parallel
+
+# Tracking
+# labels the regions of every frame with 8-connectivity, regions smaller than `min_area` pixels are dropped
+def label_frames(mask, min_area):
+    labels = np.zeros(mask.shape, dtype=np.int32)
+    for frame in range(mask.shape[0]):
+        frame_labels, n_labels = ndimage.label(mask[frame], structure=EIGHT_CONNECTIVITY)
+        keep = np.bincount(frame_labels.ravel(), minlength=n_labels + 1) >= min_area
+        keep[0] = False # background
+        lut = np.zeros(n_labels + 1, dtype=np.int32)
+        lut[keep] = np.arange(1, np.count_nonzero(keep) + 1)
+        labels[frame] = lut[frame_labels]
+    return labels
+
+# links each region to the region of the previous frame it overlaps the most, largest overlaps are linked first
+# regions without a link start a new track, so every track covers consecutive frames
+# returns the track label timelapse, 0 is background
+def link_tracks(labels):
+    track_labels = np.zeros(labels.shape, dtype=np.int32)
+    n_tracks, previous_lut, n_previous = 0, None, 0
+    for frame in range(labels.shape[0]):
+        n_labels = int(labels[frame].max())
+        lut = np.zeros(n_labels + 1, dtype=np.int32) # region label -> track
+        if(frame > 0 and n_labels > 0 and n_previous > 0):
+            both = (labels[frame-1] > 0) & (labels[frame] > 0)
+            pairs = labels[frame-1][both].astype(np.int64) * (n_labels + 1) + labels[frame][both]
+            overlaps = np.bincount(pairs, minlength=(n_previous + 1) * (n_labels + 1)).reshape(n_previous + 1, n_labels + 1)
+            previous, current = np.nonzero(overlaps)
+            linked = set()
+            for order in np.argsort(-overlaps[previous, current], kind='stable'):
+                if(lut[current[order]] == 0 and previous[order] not in linked):
+                    lut[current[order]] = previous_lut[previous[order]]
+                    linked.add(previous[order])
+        for region in range(1, n_labels + 1):
+            if(lut[region] == 0):
+                n_tracks += 1
+                lut[region] = n_tracks
+        track_labels[frame] = lut[labels[frame]]
+        previous_lut, n_previous = lut, n_labels
+    return track_labels
+
+# crops of the tracks present in at least `min_frames` frames: (track, frames slice, y slice, x slice)
+# the crops are padded by `margin` pixels so the midline and the kymograph kernel fit inside
+def track_crops(track_labels, min_frames, margin):
+    crops = []
+    for track, bounds in enumerate(ndimage.find_objects(track_labels), start=1):
+        if(bounds is None or bounds[0].stop - bounds[0].start < min_frames): continue
+        frames, rows, cols = bounds
+        rows = slice(max(0, rows.start - margin), min(track_labels.shape[1], rows.stop + margin))
+        cols = slice(max(0, cols.start - margin), min(track_labels.shape[2], cols.stop + margin))
+        crops.append((track, frames, rows, cols))
+    return crops
+
+# Per-Track Analysis
+# runs steps 3 to 5 of the pipeline on the crop of one track, inside a worker process when workers > 1
+# the extrapolated midline reaches beyond the crop, it is returned in frame coordinates and sampled by `run`
+def analyze_track(cell, mask, median_c_1, median_c_0, thresholds, args, origin=(0, 0), frame_shape=None):
+    dtype = PRECISIONS[args.precision]
+    result = {'cell': cell, 'status': 'ok', 'tables': {}, 'stacks': {'binary_mask': mask.astype(np.uint8)}}
+    try:
+        # 3 skeletonize
+        last_frame = mask.shape[0] - 1
+        if(args.a):
+            skeleton_timelapse, skeleton_coordinates = skeletonize_all_frames(mask, 1, args.midline)
+            first_skeleton_object, skeleton_object = skeleton_coordinates[0], skeleton_coordinates[last_frame]
+            result['stacks']['skeletonized'] = skeleton_timelapse.astype(np.uint8)
+        else:
+            skeleton, skeleton_object = skeletonization(mask[last_frame], args.midline)
+            _, first_skeleton_object = skeletonization(mask[0], args.midline)
+            result['stacks']['skeletonized'] = skeleton.astype(np.uint8)
+        angle, coordinates, growing_forward = get_growth_direction(first_skeleton_object, skeleton_object)
+        result['angle'], result['growing_forward'] = angle, growing_forward
+
+        # 4 kymograph
+        if(not args.a):
+            origin = np.array(origin)
+            frame_skeleton = np.zeros(frame_shape or skeleton.shape, dtype=bool)
+            frame_skeleton[origin[0]:origin[0] + skeleton.shape[0], origin[1]:origin[1] + skeleton.shape[1]] = skeleton
+            frame_object = SkeletonCoordinates(skeleton_object.coordinates + origin, skeleton_object.degrees, getattr(skeleton_object, 'ordered', False))
+            extended_skeleton, _ = extend_skeleton(frame_skeleton, frame_object, angle, coordinates + origin, args.f, args.e, growing_forward, args.extrapolation_model)
+            result['midline'] = extended_skeleton.coordinates
+        else:
+            result['tables']['kymograph_c_1'] = kymograph_framewise(median_c_1, skeleton_coordinates, args.k, growing_forward, args.lw)
+            if(median_c_0 is not None): result['tables']['kymograph_c_0'] = kymograph_framewise(median_c_0, skeleton_coordinates, args.k, growing_forward, args.lw)
+
+        # 5 ratiometric crop
+        if(median_c_0 is not None):
+            signal = RegionIndex.from_frames([np.flatnonzero(frame) for frame in mask], mask.shape[1:])
+            ratio, _ = ratiometric_vectorized(median_c_0, median_c_1, signal, mask, thresholds, args.sm, args.o, args.r, dtype)
+            if(args.b): result['stacks']['ratiometric'] = ratio.copy()
+            masked_ratio = masked_foreground(ratio, mask)
+            if(not args.b): result['stacks']['ratiometric'] = masked_ratio
+            if(not args.a): result['tables']['kymograph_ratio'] = kymograph(masked_ratio, skeleton_object.coordinates, args.k, growing_forward, args.lw)
+            else: result['tables']['kymograph_ratio'] = kymograph_framewise(masked_ratio, skeleton_coordinates, args.k, growing_forward, args.lw)
+    except Exception:
+        result['status'] = 'failed: ' + traceback.format_exc(limit=1).strip().splitlines()[-1]
+    return result
+
+# writes the products of a cell as `{filename}_cell_{cell}_*`
+def write_cell(result, crop, args):
+    cell, frames, rows, cols = crop
+    writer = OutputWriter(f'{args.filename}_cell_{cell}', args.output_format, args.container, args.write_buffer * 1024**2)
+    for name, stack in result['stacks'].items(): writer.stack(name, stack)
+    shifted_turbo_cmap = generate_cmap(args.sf) if writer.writes_previews else None
+    for name, table in result['tables'].items():
+        cmap = shifted_turbo_cmap if args.a or name == 'kymograph_ratio' else 'turbo'
+        writer.image(name, table, cmap)
+        writer.table(name, table)
+    writer.metadata(cell=cell, frames=[frames.start, frames.stop], bbox=[rows.start, rows.stop, cols.start, cols.stop], growing_forward=result.get('growing_forward'), angle=result.get('angle'))
+    writer.close()
+
+# Runs the multi-cell pipeline on a single timelapse
+def run(args):
+    ts = time.time()
+    dtype = PRECISIONS[args.precision]
+    check_dependencies(args.output_format, args.container) # the cell writers are only created after the analysis
+    recorder = instrumentation.activate(Recorder(args.report is not None, args.profile, args.profiler, args.filename))
+
+    # 1 FILE READING
+    with recorder.stage('reading'):
+        im = read_timelapse(args.filename)
+        print(args.filename, "shape:", im.shape)
+        if(im.ndim == 4): c_0, c_1 = im[:,0,:,:], im[:,1,:,:]
+        elif(im.ndim == 3): c_0, c_1 = None, im
+        else: raise Exception('Invalid number of dimensions.')
+    n_frames = c_1.shape[0]
+
+    # 2 SEGMENTATION, once for every cell
+    print('[2] segmentation')
+    with recorder.stage('filters_thresholding', n_frames):
+        chunk_size = frame_chunk_size(c_1, args.max_memory, filter_halo(args.s, args.footprint))
+        median_c_0 = median_stream(c_0, chunk_size, allocate(c_0.shape, c_0.dtype, args.max_memory), args.footprint) if c_0 is not None else None
+        median_c_1, _, mask_c_1, thresh_c_1 = segmentation_stream(c_1, args.s, chunk_size, args.n, args.eb, args.v, '.', args.filename, args.workers, allocate(c_1.shape, c_1.dtype, args.max_memory), dtype=dtype, footprint=args.footprint)
+
+    # tracking
+    print('[2.3] linking regions into cell tracks')
+    with recorder.stage('tracking', n_frames):
+        track_labels = link_tracks(label_frames(mask_c_1, args.min_area))
+        del mask_c_1 # decrease ref counter
+        crops = track_crops(track_labels, args.min_frames, args.margin)
+        recorder.count('cells', len(crops))
+    print(f'[2.3] {len(crops)} cells')
+
+    # 3-5 PER-CELL ANALYSIS
+    print('[3-5] per-cell midline, kymograph and ratiometric analysis')
+    with recorder.stage('cells', n_frames):
+        jobs = []
+        for cell, frames, rows, cols in crops:
+            mask = track_labels[frames, rows, cols] == cell
+            crop_c_0 = np.asarray(median_c_0[frames, rows, cols]) if median_c_0 is not None else None
+            jobs.append((cell, mask, np.asarray(median_c_1[frames, rows, cols]), crop_c_0, np.asarray(thresh_c_1)[frames], args, (rows.start, cols.start), c_1.shape[1:]))
+        if(args.workers > 1 and len(jobs) > 1):
+            with ProcessPoolExecutor(max_workers=min(args.workers, len(jobs))) as executor:
+                results = list(executor.map(analyze_track, *zip(*jobs)))
+        else:
+            results = [analyze_track(*job) for job in jobs]
+
+        # kymographs of the extrapolated midlines, sampled on the whole frames
+        for result, (cell, frames, rows, cols) in zip(results, crops):
+            if('midline' not in result): continue
+            midline = result.pop('midline')
+            kymographs = {'kymograph_c_1': kymograph(median_c_1[frames], midline, args.k, result['growing_forward'], args.lw)}
+            if(median_c_0 is not None): kymographs['kymograph_c_0'] = kymograph(median_c_0[frames], midline, args.k, result['growing_forward'], args.lw)
+            result['tables'] = {**kymographs, **result['tables']}
+
+    with recorder.stage('write_cells'):
+        with open(f'{args.filename}_cells.csv', 'w', newline='') as summary:
+            writer = csv.DictWriter(summary, fieldnames=['cell', 'first_frame', 'last_frame', 'y0', 'y1', 'x0', 'x1', 'growing_forward', 'status'])
+            writer.writeheader()
+            for result, crop in zip(results, crops):
+                cell, frames, rows, cols = crop
+                write_cell(result, crop, args)
+                writer.writerow({'cell': cell, 'first_frame': frames.start, 'last_frame': frames.stop - 1, 'y0': rows.start, 'y1': rows.stop, 'x0': cols.start, 'x1': cols.stop,
+                                 'growing_forward': result.get('growing_forward'), 'status': result['status']})
+                print(f"[cell {cell}] frames {frames.start}-{frames.stop - 1}, {result['status']}")
+
+    if(args.report is not None): recorder.write(args.report, filename=args.filename, arguments=vars(args))
+    print(f'[timestamp] {time.time() - ts:.2f}s')
+    return results
+
+if __name__ == "__main__":
+    # Argument Parsing
+    parser = argparse.ArgumentParser(description='AMEBaS multi-cell mode: tracks and analyzes every cell in the field of view.')
+    parser.add_argument('filename', type=str, metavar='filename', help='Input timelapse filename. May be a .dv or a .tiff file.')
+    parser.add_argument("--min-area", type=int, nargs="?", default=100, help='Regions smaller than this many pixels are ignored. Default is 100.')
+    parser.add_argument("--min-frames", type=int, nargs="?", default=2, help='Cells tracked in fewer frames are ignored. Default is 2.')
+    parser.add_argument("--margin", type=int, nargs="?", default=10, help='Padding in pixels of the cell crops. Default is 10.')
+    run(add_arguments(parser).parse_args())
@@ -0,0 +1,282 @@
+# utilities
+import os
+import time
+import struct
+import argparse
+import numpy as np
+
+# image processing
+import tifffile
+from skimage import filters
+
+# repository
+# skimage.io, loess and matplotlib are only imported by the features that use them, see pipeline.py
+from visualization import generate_cmap
+from processing import PRECISIONS, MEDIAN_HALO, gaussian_halo, median_filter, gaussian_filter, isolate_largest_area, skeletonization, get_growth_direction, kymograph_framewise, ratiometric_vectorized, masked_foreground
+from writers import OutputWriter, TABLE_FORMATS, check_dependencies
+from batch import is_timelapse
+
+# Online Mode
+# processes the frames of a timelapse while the microscope writes them and appends one kymograph row per frame
+# frame t is filtered once the median frames t-halo..t+halo exist, i.e. `gaussian_halo(sigma) + MEDIAN_HALO` frames
+# after it arrives, with the same 3-D median and gaussian windows as the offline pipeline, so masks, thresholds and
+# rows match a `--a` run of pipeline.py; every buffer is bounded, so the work per frame does not grow with the timelapse
+
+# Frame Sources
+# a growing .tif/.tiff file, `channels` consecutive pages per frame
+# the chain of IFDs is followed from the last parsed one, so a poll only reads the pages added since the previous poll,
+# and a page is parsed once its IFD and image data are inside the file, whether or not the file is still growing
+class TiffSource:
+    def __init__(self, filename, channels=None):
+        self.filename = filename
+        self.channels = channels
+        self.pointer = None # file offset of the offset of the next IFD
+        self.pages = [] # pages of the incomplete frame
+
+    # returns the frames added since the last poll, (channels, Y, X) or (Y, X)
+    def poll(self):
+        if(not os.path.exists(self.filename) or os.path.getsize(self.filename) < 16): return [] # missing or no header yet
+        frames = []
+        with tifffile.TiffFile(self.filename) as tif:
+            if(self.channels is None): self.channels = int((tif.imagej_metadata or {}).get('channels', 1))
+            if(self.pointer is None): self.pointer = 8 if tif.is_bigtiff else 4
+            while((page := self.next_page(tif)) is not None):
+                self.pages.append(page)
+                if(len(self.pages) < self.channels): continue
+                frame = np.stack(self.pages)
+                frames.append(frame if self.channels > 1 else frame[0])
+                self.pages = []
+        return frames
+
+    # parses the IFD after the last parsed one, None if there is none or it is not completely written yet
+    def next_page(self, tif):
+        tiff, handle, size = tif.tiff, tif.filehandle, tif.filehandle.size
+        if(self.pointer + tiff.offsetsize > size): return None
+        handle.seek(self.pointer)
+        offset = struct.unpack(tiff.offsetformat, handle.read(tiff.offsetsize))[0]
+        if(offset == 0 or offset + tiff.tagnosize > size): return None
+        handle.seek(offset)
+        n_tags = struct.unpack(tiff.tagnoformat, handle.read(tiff.tagnosize))[0]
+        pointer = offset + tiff.tagnosize + n_tags * tiff.tagsize
+        if(pointer + tiff.offsetsize > size): return None
+        try:
+            handle.seek(offset)
+            page = tifffile.TiffPage(tif, index=0)
+            if(any(start + length > size for start, length in zip(page.dataoffsets, page.databytecounts))): return None
+            image = page.asarray()
+        except Exception: return None # tag values not written yet, parsed again at the next poll
+        self.pointer = pointer
+        return image
+
+# a directory where every new .tif/.tiff file is one frame, frames are ordered by filename
+class DirectorySource:
+    def __init__(self, directory):
+        self.directory = directory
+        self.seen = set()
+        self.pending = {}
+
+    def poll(self):
+        frames = []
+        for name in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory, name)
+            if(name in self.seen or not is_timelapse(path)): continue
+            size = os.path.getsize(path)
+            if(self.pending.get(name) != size): # new or still being written
+                self.pending[name] = size
+                break # keeps the frame order
+            del self.pending[name]
+            self.seen.add(name)
+            from skimage import io
+            frames.append(np.asarray(io.imread(path)))
+        return frames
+
+def open_source(path, channels=None):
+    if(os.path.isdir(path)): return DirectorySource(path)
+    return TiffSource(path, channels)
+
+# Online Processing
+class OnlinePipeline:
+    def __init__(self, args, prefix):
+        self.args = args
+        self.prefix = prefix
+        self.dtype = PRECISIONS[args.precision]
+        self.halo = gaussian_halo(args.s)
+        self.n_frames = 0 # frames received
+        self.n_filtered = 0 # frames filtered and analyzed
+        self.finished = False
+
+        # rolling buffers indexed by frame, pruned as soon as no window needs them
+        self.raw = {} # (channels, Y, X)
+        self.median = {} # (channels, Y, X)
+
+        # per frame results
+        self.thresholds, self.smooth_thresholds = [], []
+        self.rows = {'c_1': [], 'c_0': [], 'ratio': []} # kymograph rows in skan order
+        self.first_skeleton_object = None
+        self.growing_forward = True
+        self.written_forward = True # orientation of the rows in the live tables
+        self.latencies = []
+        self.arrivals = {}
+
+    # adds a new frame and analyzes every frame whose filter windows are complete
+    def push(self, frame):
+        frame = frame if frame.ndim == 3 else frame[np.newaxis]
+        self.raw[self.n_frames] = frame
+        self.arrivals[self.n_frames] = time.perf_counter()
+        self.n_frames += 1
+        if(self.n_frames > MEDIAN_HALO): self.filter_median(self.n_frames - 1 - MEDIAN_HALO)
+        while(self.n_filtered + self.halo < self.n_frames - MEDIAN_HALO): self.analyze(self.n_filtered)
+
+    # analyzes the remaining frames once the acquisition is over, the windows are clipped like in the offline pipeline
+    def flush(self):
+        self.finished = True
+        for index in self.arrivals: self.arrivals[index] = time.perf_counter() # the end of the acquisition is only known now
+        for frame in range(max(0, self.n_frames - MEDIAN_HALO), self.n_frames): self.filter_median(frame)
+        while(self.n_filtered < self.n_frames): self.analyze(self.n_filtered)
+
+    # 3-D median of one frame, from its neighbouring input frames
+    def filter_median(self, frame):
+        lo, hi = max(0, frame - MEDIAN_HALO), min(self.n_frames, frame + MEDIAN_HALO + 1)
+        window = np.stack([self.raw[index] for index in range(lo, hi)], axis=1) # channels, frames, Y, X
+        self.median[frame] = np.stack([median_filter(channel)[frame - lo] for channel in window])
+        for index in [index for index in self.raw if index < frame - MEDIAN_HALO + 1]: del self.raw[index]
+
+    def analyze(self, frame):
+        args = self.args
+        hi = frame + self.halo + 1 if not self.finished else min(self.n_frames, frame + self.halo + 1)
+        lo = max(0, frame - self.halo)
+
+        # 2 segmentation: gaussian over the median window, isodata threshold, largest region
+        median_window = np.stack([self.median[index][-1] for index in range(lo, hi)])
+        gaussian = gaussian_filter(median_window, args.s, dtype=self.dtype)[frame - lo]
+        threshold = filters.threshold_isodata(gaussian)
+        mask, signal = isolate_largest_area((gaussian > threshold)[np.newaxis])
+        self.thresholds.append(threshold)
+        self.smooth_thresholds.append(self.rolling_loess() if args.eb else threshold)
+
+        # 3 midline and growth direction against the first frame
+        median_c_1 = self.median[frame][-1][np.newaxis]
+        skeleton, skeleton_object = skeletonization(mask[0])
+        try:
+            if(self.first_skeleton_object is None): self.first_skeleton_object = skeleton_object
+            angle, coordinates, self.growing_forward = get_growth_direction(self.first_skeleton_object, skeleton_object)
+            skeletons = [skeleton_object]
+        except (IndexError, ValueError): # skeletons without two endpoints give an empty row
+            if(self.first_skeleton_object is skeleton_object): self.first_skeleton_object = None
+            skeletons = None
+
+        # 4 kymograph rows, the orientation is applied when the rows are written
+        rows = {'c_1': median_c_1}
+        if(self.median[frame].shape[0] > 1):
+            rows['c_0'] = self.median[frame][0][np.newaxis]
+            ratio, _ = ratiometric_vectorized(rows['c_0'], median_c_1, signal, mask, self.smooth_thresholds[-1:], False, args.o, args.r, self.dtype)
+            rows['ratio'] = masked_foreground(ratio, mask)
+        for name, image in rows.items():
+            if(skeletons is None): self.rows[name].append(np.zeros(0))
+            else: self.rows[name].append(kymograph_framewise(image, skeletons, args.k, True, args.lw)[0])
+
+        # prunes the median frames no longer read by a window
+        for index in [index for index in self.median if index < frame + 1 - self.halo]: del self.median[index]
+        self.n_filtered += 1
+
+        # latency: time since the arrival of the last frame read by the windows
+        trigger = min(frame + self.halo + MEDIAN_HALO, self.n_frames - 1)
+        self.latencies.append(time.perf_counter() - self.arrivals[trigger])
+        for index in [index for index in self.arrivals if index < trigger]: del self.arrivals[index]
+        self.append(frame, mask[0], skeleton)
+
+    # causal LOESS over the last `n_points` thresholds, evaluated at the newest frame
+    def rolling_loess(self):
+        from loess.loess_1d import loess_1d
+        window = np.array(self.thresholds[-self.args.n:])
+        if(window.shape[0] < 3): return window[-1]
+        x = np.arange(window.shape[0])
+        _, smooth, _ = loess_1d(x, window, xnew=x[-1:], degree=1, frac=1., npoints=None, rotate=False, sigy=None)
+        return smooth[0]
+
+    # Live Outputs
+    # appends the mask, skeleton and kymograph rows of a frame, the kymograph previews are redrawn every `refresh` frames
+    # the live tables are rewritten in the new orientation when the growth direction flips, so all rows share one
+    def append(self, frame, mask, skeleton):
+        tifffile.imwrite(f'{self.prefix}_binary_mask.tiff', mask.astype(np.uint8), append=True, metadata=None) # pages form a single series
+        tifffile.imwrite(f'{self.prefix}_skeletonized.tiff', skeleton.astype(np.uint8), append=True, metadata=None)
+        flipped = self.growing_forward != self.written_forward
+        for name, rows in self.rows.items():
+            if(len(rows) == 0): continue
+            with open(f'{self.prefix}_kymograph_{name}_online.csv', 'w' if flipped else 'a') as output:
+                for row in (rows if flipped else rows[-1:]): output.write(','.join(f'{value:.18e}' for value in (row if self.growing_forward else row[::-1])) + '\n')
+        self.written_forward = self.growing_forward
+        if(self.args.refresh > 0 and (frame + 1) % self.args.refresh == 0): self.preview()
+        print(f'[online] frame {frame} threshold {self.thresholds[-1]:.4g} latency {1000 * self.latencies[-1]:.1f} ms')
+
+    # kymograph with one row per frame, oriented by the current growth direction
+    def kymographs(self):
+        kymographs = {}
+        for name, rows in self.rows.items():
+            if(len(rows) == 0): continue
+            kymograph = np.zeros((len(rows), max(row.shape[0] for row in rows)))
+            for frame, row in enumerate(rows): kymograph[frame, :row.shape[0]] = row if self.growing_forward else row[::-1]
+            kymographs[name] = kymograph
+        return kymographs
+
+    def preview(self):
+        writer, cmap = OutputWriter(self.prefix), generate_cmap(self.args.sf)
+        for name, kymograph in self.kymographs().items(): writer.image(f'kymograph_{name}', kymograph, cmap)
+
+    # final tables, oriented by the growth direction between the first and the last frame
+    def write(self):
+        writer = OutputWriter(self.prefix, self.args.output_format)
+        writer.table('background_treshold_c_1', self.smooth_thresholds)
+        cmap = generate_cmap(self.args.sf)
+        for name, kymograph in self.kymographs().items():
+            writer.image(f'kymograph_{name}', kymograph, cmap)
+            writer.table(f'kymograph_{name}', kymograph)
+        writer.close()
+        if(len(self.latencies) > 0): print(f'[online] {self.n_filtered} frames, latency median {1000 * np.median(self.latencies):.1f} ms, max {1000 * np.max(self.latencies):.1f} ms')
+
+# removes the live outputs of a previous run, they are appended to
+def clear_outputs(prefix):
+    for name in ['binary_mask.tiff', 'skeletonized.tiff'] + [f'kymograph_{channel}_online.csv' for channel in ('c_1', 'c_0', 'ratio')]:
+        if(os.path.exists(f'{prefix}_{name}')): os.remove(f'{prefix}_{name}')
+
+# polls the source until no frame arrives for `timeout` seconds or `frames` frames were received
+def watch(args):
+    check_dependencies(args.output_format) # the final tables are written after the acquisition
+    source = open_source(args.source, args.channels)
+    prefix = args.source.rstrip(os.sep) # outputs of a directory source are written next to it
+    clear_outputs(prefix)
+    pipeline = OnlinePipeline(args, prefix)
+    last_frame = time.time()
+    try:
+        while(args.frames is None or pipeline.n_frames < args.frames):
+            frames = source.poll()
+            for frame in frames: pipeline.push(frame)
+            if(len(frames) > 0): last_frame = time.time()
+            elif(time.time() - last_frame > args.timeout): break
+            else: time.sleep(args.interval)
+    except KeyboardInterrupt:
+        print('[online] interrupted')
+    pipeline.flush()
+    pipeline.write()
+    return pipeline
+
+if __name__ == "__main__":
+    # Argument Parsing
+    parser = argparse.ArgumentParser(description='AMEBaS online mode: analyzes a timelapse while it is acquired.')
+    parser.add_argument('source', type=str, help='Growing .tif/.tiff timelapse or directory where each new .tif/.tiff file is a frame.')
+    parser.add_argument("--channels", type=int, nargs="?", default=None, help='Pages per frame of a TIFF source. Read from the ImageJ metadata by default, otherwise 1.')
+    parser.add_argument("--interval", type=float, nargs="?", default=.5, help='Seconds between polls of the source. Default is 0.5.')
+    parser.add_argument("--timeout", type=float, nargs="?", default=30., help='Seconds without new frames after which the acquisition is considered finished. Default is 30.')
+    parser.add_argument("--frames", type=int, nargs="?", default=None, help='Stops after this number of frames. By default, stops on timeout.')
+    parser.add_argument("--refresh", type=int, nargs="?", default=10, help='Frames between redraws of the kymograph previews, 0 disables them. Default is 10.')
+    parser.add_argument("--precision", type=str, choices=['float32', 'float64'], default='float32', help='Floating point precision of the intermediate frames. Default is float32.')
+    parser.add_argument("--output-format", type=str, choices=TABLE_FORMATS, default='csv', help='Format of the final threshold and kymograph tables. Default is csv.')
+    parser.add_argument("--s", "--sigma", type=int, nargs="?", default=2, help='Sigma used in the Gaussian Filter preprocessing step. Default is 2.')
+    parser.add_argument("--sf", "--shift_fraction", type=float, nargs="?", default=.7, help='Fraction of the color range that will be shifted to the background in the kymographs. Default is 0.7.')
+    parser.add_argument("--k", "--kymograph_kernel", type=int, nargs="?", default=3, help='Size of the kernel used in the kymograph Gaussian filtering. Default is 3.')
+    parser.add_argument("--lw", "--line_width", type=int, nargs="?", default=1, help='Width in pixels of the kymograph line. Default is 1.')
+    parser.add_argument("--eb", "--estimate_bg_threshold_intensity", default=False, action='store_true', help='Smooths the background threshold intensities with a rolling loess over the last --n frames. Default is false.')
+    parser.add_argument("--n", "--n_points", type=int, nargs="?", default=40, help='Number of frames of the rolling loess window. Default is 40.')
+    parser.add_argument("--r", "--switch_ratio", default=False, action='store_true', help='Switches channels used as numerator and denominator during ratio calculations.')
+    parser.add_argument("--o", "--reject_outliers", default=False, action='store_true', help='Rejects pixels with abnormal ratios and replaces them with the local median. Default is false.')
+    watch(parser.parse_args())
@@ -0,0 +1,77 @@
+# Imports
+# utilities
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+# Frame-Parallel Execution
+# timelapses are exchanged with the worker processes through shared memory blocks,
+# only the chunk bounds and the small per-frame results are pickled
+
+# allocates a shared memory block with the given shape and dtype
+def create_shared(shape, dtype):
+    dtype = np.dtype(dtype)
+    block = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * dtype.itemsize))
+    return block, (block.name, shape, dtype.str)
+
+# attaches to a shared memory block created by the parent process
+def attach_shared(descriptor):
+    name, shape, dtype = descriptor
+    block = shared_memory.SharedMemory(name=name)
+    return block, np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+# splits the timelapse in contiguous frame chunks, a few per worker to balance the load
+def frame_chunks(n_frames, workers, chunks_per_worker=4):
+    n_chunks = max(1, min(n_frames, workers * chunks_per_worker))
+    bounds = np.linspace(0, n_frames, n_chunks + 1).astype(int)
+    return [(start, stop) for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+
+# runs `function(inputs, outputs, start, stop, *args)` in a worker process
+def run_chunk(function, input_descriptors, output_descriptors, start, stop, args):
+    blocks, inputs, outputs = [], {}, {}
+    try:
+        for name, descriptor in input_descriptors.items():
+            block, inputs[name] = attach_shared(descriptor)
+            blocks.append(block)
+        for name, descriptor in output_descriptors.items():
+            block, outputs[name] = attach_shared(descriptor)
+            blocks.append(block)
+        return function(inputs, outputs, start, stop, *args)
+    finally:
+        inputs.clear()
+        outputs.clear()
+        for block in blocks: block.close()
+
+# maps `function` over frame chunks of the timelapse using a process pool
+# inputs: name -> array, outputs: name -> (shape, dtype)
+# returns the output arrays and the per-chunk results concatenated in frame order
+def map_frames(function, inputs, outputs, n_frames, workers, args=()):
+    blocks = []
+    try:
+        input_descriptors = {}
+        for name, array in inputs.items():
+            block, descriptor = create_shared(array.shape, array.dtype)
+            blocks.append(block)
+            np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+            input_descriptors[name] = descriptor
+        output_descriptors, output_views = {}, {}
+        for name, (shape, dtype) in outputs.items():
+            block, descriptor = create_shared(shape, dtype)
+            blocks.append(block)
+            output_descriptors[name] = descriptor
+            output_views[name] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+        chunks = frame_chunks(n_frames, workers)
+        with ProcessPoolExecutor(max_workers=min(workers, len(chunks))) as executor:
+            futures = [executor.submit(run_chunk, function, input_descriptors, output_descriptors, start, stop, args) for start, stop in chunks]
+            results = []
+            for future in futures: results.extend(future.result()) # submission order keeps frames ordered
+
+        arrays = {name: view.copy() for name, view in output_views.items()}
+    finally:
+        output_views = None # releases the buffers before closing the blocks
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    return arrays, results
@@ -1,39 +1,56 @@
 # utilities
+import os
 import time
 import argparse
 import numpy as np
 
-# image processing
-from mrc import imread # dv reader
-from skan import Skeleton
-from skimage import io, filters
-
-# visualization
-from matplotlib import pyplot as plt
-
 # repository
-from visualization import *
-from processing import *
+# matplotlib, skan and loess are only imported by the features that use them (previews, verbose plots, the skan
+# midline and --eb), so importing the pipeline as a library stays fast
+from visualization import display, display_single, display_frames, generate_cmap
+from processing import PRECISIONS, MEDIAN_HALO, EXTRAPOLATION_MODELS, FOOTPRINTS, filter_halo, median_stream, segmentation_stream, isolate_largest_area, \
+    skeletonize_all_frames, skeletonization, get_growth_direction, extend_skeleton, roi_bounds, crop_skeleton, uncrop, \
+    kymograph, kymograph_framewise, ratiometric, ratiometric_vectorized, masked_foreground
+from reader import read_timelapse, frame_chunk_size, allocate
+import instrumentation
+from instrumentation import Recorder
+from cache import StageCache, pack_regions, unpack_regions, pack_skeletons, unpack_skeletons
+from writers import OutputWriter, MemoryWriter, TABLE_FORMATS, CONTAINERS
 
-if __name__ == "__main__":
-    # execution time
-    ts = time.time()
-    print(f'[timestamp] {ts}')
+TRUE_VALUES = ('1', 'true', 'yes', 'y')
 
-    # Argument Parsing
-    parser = argparse.ArgumentParser(description='AMEBaS: Automatic Midline Extraction and Background Subtraction')
+# Argument Parsing
+# adds the pipeline options, shared by the single file and batch entry points
+def add_arguments(parser):
     # [1] Timelapse Input
-    parser.add_argument('filename', type=str, metavar='filename', help='Input timelapse filename. May be a .dv or a .tiff file.')
     parser.add_argument("--v", "--verbose", default=False, action='store_true', help='Outputs internal steps of the pipeline.')
+    parser.add_argument("--max-memory", type=int, nargs="?", default=None, help='Memory budget in megabytes for the filtering and thresholding stages. Frames are streamed in chunks sized to fit the budget and large intermediate timelapses are kept on disk. By default the whole timelapse is processed at once.')
+    parser.add_argument("--precision", type=str, choices=['float32', 'float64'], default='float32', help='Floating point precision of the intermediate timelapses. Masks and skeletons are always binary. float64 reproduces double precision results. Default is float32.')
+    parser.add_argument("--cache", type=str, nargs="?", default=None, help='Directory of the stage cache. Stage results are reused by reruns with the same input and stage parameters, so only the stages downstream of a changed argument are recomputed. Disabled by default.')
+    parser.add_argument("--cache-size", type=int, nargs="?", default=2048, help='Size cap of the stage cache in megabytes. Least recently used entries are evicted first. Default is 2048.')
+    parser.add_argument("--report", type=str, nargs="?", default=None, help='Filename of a JSON run report with wall time, CPU time, process and worker memory high-water marks and counters of every stage and processing function. Disabled by default.')
+    parser.add_argument("--profile", type=str, action='append', default=[], metavar='STAGE', help='Profiles a pipeline stage (e.g. ratiometric) and writes the profile next to the input. May be repeated.')
+    parser.add_argument("--profiler", type=str, choices=['cprofile', 'pyinstrument'], default='cprofile', help='Profiler used by --profile. pyinstrument must be installed separately. Default is cprofile.')
+    parser.add_argument("--output-format", type=str, choices=TABLE_FORMATS, default='csv', help='Format of the threshold and kymograph tables: csv, npy, compressed npz or parquet (requires pyarrow). Default is csv.')
+    parser.add_argument("--container", type=str, choices=CONTAINERS, default='none', help='Writes every product of the run (tables, mask, skeleton and ratiometric timelapses and run metadata) into a single compressed container {filename}_amebas.npz/.h5/.zarr instead of separate files. hdf5 requires h5py and zarr requires zarr. Default is none.')
+    parser.add_argument("--write-buffer", type=int, nargs="?", default=256, help='Memory cap in megabytes of the outputs waiting to be written. Outputs and verbose figures are written by a background thread while the next stages run, and every write is checked before the run ends. 0 writes synchronously. Default is 256.')
+    parser.add_argument("--workers", type=int, nargs="?", default=1, help='Number of worker processes used by the per-frame stages (thresholding, region isolation and skeletonization). Default is 1.')
+    parser.add_argument("--roi", default=False, action='store_true', help='Computes the first channel median, the ratiometric timelapse and the kymographs only inside the bounding box of the cell over time and its extrapolated midline. Outputs are the same as full frame processing. Ignored with --b. Default is false.')
+    parser.add_argument("--roi-margin", type=int, nargs="?", default=8, help='Padding in pixels of the --roi box, in addition to the padding needed by the median and kymograph kernels. Default is 8.')
     # [2] Single-Cell Segmentation
     parser.add_argument("--s", "--sigma", type=int, nargs="?", default=2, help='Sigma used in the Gaussian Filter preprocessing step in preparation to the cell segmentation. Default is 2.')
+    parser.add_argument("--footprint", type=str, choices=FOOTPRINTS, default='3d', help='Footprint of the median and Gaussian preprocessing filters. 3d also filters along time, mixing neighbouring frames (3x3x3 median), 2d filters every frame on its own (3x3 median) and needs no neighbouring frames. Default is 3d.')
+    parser.add_argument("--search-margin", type=int, nargs="?", default=None, help='Searches the largest region only inside the bounding box of the previous frame region padded by this many pixels. The whole frame is searched again when the region reaches the border of the box. By default, every frame is searched whole.')
     # [3] Midline Tracing
     parser.add_argument("--a", "--complete_skeletonization", default=False, action='store_true', help='Traces the midline for each frame of the timelapse. By default, skeletonizes only the last frame.')
+    parser.add_argument("--midline", type=str, choices=['path', 'skan'], default='path', help='Midline extraction. path traces the ordered midline directly from the skeleton and falls back to skan on branched skeletons, skan builds the skan skeleton graph of every skeleton. Default is path.')
     parser.add_argument("--f", "--interpolation_fraction", type=float, nargs="?", default=.25, help='Fraction of the skeleton used for interpolation. Must be float contained in [0,1]. Default is 0.25.')
     parser.add_argument("--e", "--extrapolation_length", type=int, nargs="?", default=-1, help='Length in pixels of the extrapolated skeleton. Extrapolates to the edge of the image by default.')
+    parser.add_argument("--extrapolation-model", type=str, choices=EXTRAPOLATION_MODELS, default='endpoints', help='Fit used to extrapolate the midline: endpoints (line through the first and last interpolation points), lstsq (least squares line over the interpolation points) or spline (smoothing spline). Default is endpoints.')
     # [4] Kymograph Generation
     parser.add_argument("--sf", "--shift_fraction", type=float, nargs="?", default=.7, help='Fraction of the color range that will be shifted to the background in non-extrapolated kymographs. Default is 0.7.')
     parser.add_argument("--k", "--kymograph_kernel", type=int, nargs="?", default=3, help='Size of the kernel used in the kymograph Gaussian filtering. Default is 3.')
+    parser.add_argument("--lw", "--line_width", type=int, nargs="?", default=1, help='Width in pixels of the kymograph line. Wider lines average the intensities perpendicular to the midline. Default is 1.')
     # [5] Ratiometric Timelapse Generation
     parser.add_argument("--eb", "--estimate_bg_threshold_intensity", default=False, action='store_true', help='Estimates global background threshold intensity via loess polynomial regression of the frame-specific background threshold intensities. Default is false.')
     parser.add_argument("--n", "--n_points", type=int, nargs="?", default=40, help='Number of points used in loess smoothing of the background threshold values. Used only with --eb. Default is 40.')
@@ -41,113 +58,240 @@ if __name__ == "__main__":
     parser.add_argument("--sm", "--smooth_ratio", default=False, action='store_true', help='Smooths ratiometric output by applying a Median Filter pass. Default is false.')
     parser.add_argument("--o", "--reject_outliers", default=False, action='store_true', help='During the ratiometric timelapse generation, rejects pixels with abnormal intensities and replaces with the local average. Default is false.')
     parser.add_argument("--b", "--background_ratio", default=False, action='store_true', help='Export background in the ratiometric output. By default, replaces background with zeros.')
-    
-    args = parser.parse_args()
+    parser.add_argument("--engine", type=str, choices=['legacy', 'vectorized'], default='vectorized', help='Ratiometric engine. The vectorized engine processes the whole timelapse with array operations and produces the same output as the legacy per-pixel engine. Default is vectorized.')
+
+    return parser
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='AMEBaS: Automatic Midline Extraction and Background Subtraction')
+    parser.add_argument('filename', type=str, metavar='filename', help='Input timelapse filename. May be a .dv or a .tiff file.')
+    return add_arguments(parser)
+
+# maps option names (`sf`, `shift_fraction`, `--sf`) to parser destinations
+def option_actions(parser):
+    actions = {}
+    for action in parser._actions:
+        for option in action.option_strings: actions[option.lstrip('-')] = action
+        actions[action.dest] = action
+    return actions
+
+# sets the options given by name over `args`, string values are converted with the option type
+def apply_options(args, actions, options):
+    for key, value in options.items():
+        key = key.lstrip('-')
+        if(key not in actions): raise Exception(f'Unknown pipeline option {key} for {args.filename}.')
+        action = actions[key]
+        if(isinstance(value, str)):
+            if(isinstance(action, argparse._StoreTrueAction)): value = value.strip().lower() in TRUE_VALUES
+            elif(action.type is not None): value = action.type(value)
+        setattr(args, action.dest, value)
+    return args
+
+# Library API
+# runs the pipeline on a timelapse array (frames, [channels,] Y, X) or filename and returns the products in memory:
+# the threshold and kymograph tables, the mask, skeleton and ratiometric timelapses and the run metadata, by name
+# config: pipeline options by name, e.g. {'sigma': 3, 'a': True}, missing options take their command line defaults
+# nothing is written to disk unless an option asks for it (verbose, report, profile, cache or max-memory)
+def run_pipeline(array_or_path, config=None):
+    parser = build_parser()
+    is_path = isinstance(array_or_path, (str, os.PathLike))
+    args = apply_options(parser.parse_args([os.fspath(array_or_path) if is_path else '<array>']), option_actions(parser), config or {})
+    if(not is_path and args.cache is not None): raise Exception('The stage cache requires a timelapse filename.')
+    writer = MemoryWriter()
+    run(args, None if is_path else np.asarray(array_or_path), writer)
+    return writer.results
+
+# renders a verbose `display` figure on the writer thread, from a copy of the displayed frames
+def display_later(writer, image, title, filename, id, workDir, colorMap):
+    frames = display_frames(image.shape[0])
+    writer.render(display, np.array(image[frames]), title, filename, id, workDir, colorMap, frames)
+
+# Runs the pipeline on a single timelapse
+# image: timelapse array used instead of reading `args.filename`, writer: output writer, OutputWriter by default
+def run(args, image=None, writer=None):
+    # execution time
+    ts = time.time()
+    print(f'[timestamp] {ts}')
+
+    dtype = PRECISIONS[args.precision] # floating point intermediates
+    cache = StageCache(args.cache, args.cache_size)
+    recorder = instrumentation.activate(Recorder(args.report is not None, args.profile, args.profiler, args.filename))
+    if(writer is None): writer = OutputWriter(args.filename, args.output_format, args.container, args.write_buffer * 1024**2)
 
     # 1 FILE READING
     workDir = "./"
     print('[1] file reading')
-    if(".dv" in  args.filename):
-        im = imread(args.filename)
-    elif(".tiff" in  args.filename):
-        im = np.array(io.imread(args.filename))
-    elif(".tif" in  args.filename):
-        im = np.array(io.imread(args.filename))
-    else:
-        raise Exception('Filetype not recognized.')
-
-    # shape: num_images, channels, Y, X
-    print(args.filename, "shape:", im.shape)
-
-    # channel separation
-    if(im.ndim == 4):
-        hasTwoChannels = True
-    elif(im.ndim == 3):
-        hasTwoChannels = False
-    else:
-        raise Exception('Invalid number of dimensions.')
+    with recorder.stage('reading'):
+        im = read_timelapse(args.filename) if image is None else image # memory-mapped when possible
 
-    if(hasTwoChannels):
-        c_0 = im[:,0,:,:]
-        c_1 = im[:,1,:,:]
-    else:
-        c_1 = im
-    if(args.v): display(c_1, 'input', args.filename, '1', workDir, 'turbo')
+        # shape: num_images, channels, Y, X
+        print(args.filename, "shape:", im.shape)
+
+        # channel separation
+        if(im.ndim == 4):
+            hasTwoChannels = True
+        elif(im.ndim == 3):
+            hasTwoChannels = False
+        else:
+            raise Exception('Invalid number of dimensions.')
+
+        if(hasTwoChannels):
+            c_0 = im[:,0,:,:]
+            c_1 = im[:,1,:,:]
+        else:
+            c_1 = im
+        if(args.v): display_later(writer, c_1, 'input', args.filename, '1', workDir, 'turbo')
+    n_frames = c_1.shape[0]
 
     # 2 DETECTING THE MAIN CELL
     print('[2] main cell segmentation')
     print('[2.1] preprocessing filters')
-    if(hasTwoChannels): median_c_0 = filters.median(c_0)
-    median_c_1 = filters.median(c_1)
-    gaussian_c_1 = filters.gaussian(median_c_1, sigma=args.s)
-    if(args.v): display(gaussian_c_1, 'filters', args.filename, '2_1', workDir, 'turbo')
-    print('[2.2] isodata thresholding')
-    mask_c_1, thresh_c_1 = thresholding(gaussian_c_1, args.n, args.eb, args.v, '.', args.filename)
-    if(args.v): display(mask_c_1, 'thresholding', args.filename, '2_2', workDir, 'gray')
-    np.savetxt(f"{args.filename}_background_treshold_c_1.csv", thresh_c_1, delimiter=",")
+    crop_c_0 = args.roi and hasTwoChannels and not args.b # the ratio background is exported whole
+    with recorder.stage('filters_thresholding', n_frames):
+        filters_key = cache.key('filters', cache.input_key(args.filename), {'footprint': args.footprint, **({'roi': True} if crop_c_0 else {})})
+        thresholding_key = cache.key('thresholding', filters_key, {'sigma': args.s, 'estimate': args.eb, 'n_points': args.n if args.eb else None, 'precision': args.precision})
+        filtered, thresholded = cache.load(filters_key), cache.load(thresholding_key)
+        chunk_size = frame_chunk_size(c_1, args.max_memory, filter_halo(args.s, args.footprint)) # streams frame chunks within the memory budget
+        gaussian_c_1 = None
+        if(filtered is None):
+            if(hasTwoChannels and not crop_c_0): median_c_0 = median_stream(c_0, chunk_size, allocate(c_0.shape, c_0.dtype, args.max_memory), args.footprint)
+            median_c_1 = allocate(c_1.shape, c_1.dtype, args.max_memory)
+        else:
+            if(hasTwoChannels and not crop_c_0): median_c_0 = filtered['median_c_0']
+            median_c_1 = filtered['median_c_1']
+        print('[2.2] isodata thresholding')
+        if(filtered is None or thresholded is None):
+            median_c_1, gaussian_c_1, mask_c_1, thresh_c_1 = segmentation_stream(c_1, args.s, chunk_size, args.n, args.eb, args.v, '.', args.filename, args.workers, median_c_1, keep_gaussian=args.v, dtype=dtype, filtered=filtered is not None, footprint=args.footprint)
+            if(filtered is None): cache.store(filters_key, {'median_c_0': median_c_0, 'median_c_1': median_c_1} if hasTwoChannels and not crop_c_0 else {'median_c_1': median_c_1})
+            cache.store(thresholding_key, {'mask_c_1': mask_c_1, 'thresh_c_1': thresh_c_1})
+        else:
+            mask_c_1, thresh_c_1 = thresholded['mask_c_1'], thresholded['thresh_c_1']
+        if(args.v and gaussian_c_1 is not None): display_later(writer, gaussian_c_1, 'filters', args.filename, '2_1', workDir, 'turbo')
+        if(args.v): display_later(writer, mask_c_1, 'thresholding', args.filename, '2_2', workDir, 'gray')
+    with recorder.stage('write_thresholds'):
+        writer.table('background_treshold_c_1', thresh_c_1)
 
     # isolating largest area
     print('[2.3] isolating region with largest area')
-    mask_c_1, signal_c_1 = isolate_largest_area(mask_c_1)
-    if(args.v): display(mask_c_1, 'isolation', args.filename, '2_3', workDir, 'gray')
-    io.imsave(f'{args.filename}_binary_mask.tiff', mask_c_1) # exports binary mask timelapse
+    with recorder.stage('isolation', n_frames):
+        isolation_key = cache.key('isolation', thresholding_key, {'search_margin': args.search_margin})
+        isolated = cache.load(isolation_key)
+        if(isolated is None):
+            mask_c_1, signal_c_1 = isolate_largest_area(mask_c_1, args.workers, args.search_margin)
+            cache.store(isolation_key, {'mask_c_1': mask_c_1, **pack_regions(signal_c_1)})
+        else:
+            mask_c_1, signal_c_1 = isolated['mask_c_1'], unpack_regions(isolated)
+        if(recorder.enabled): recorder.count('foreground_pixels', signal_c_1.offsets.shape[0])
+        if(args.v): display_later(writer, mask_c_1, 'isolation', args.filename, '2_3', workDir, 'gray')
+    with recorder.stage('write_mask'):
+        writer.stack('binary_mask', mask_c_1.astype(np.uint8)) # exports binary mask timelapse
 
     # 3 SKELETONIZE
     last_frame = c_1.shape[0] - 1
     print("[3.1] skeletonization")
-    if(args.a):
-        skeleton_timelapse, skeleton_coordinates = skeletonize_all_frames(mask_c_1)    # skeletonizes all frames
-        io.imsave(f'{args.filename}_skeletonized.tiff', skeleton_timelapse) # exports skeleton timelapse
-        skeleton, skeleton_object = skeleton_timelapse[last_frame], skeleton_coordinates[last_frame]
-        first_skeleton, first_skeleton_object = skeleton_timelapse[0], skeleton_coordinates[0]
-    else:
-        skeleton, skeleton_object = skeletonization(mask_c_1[last_frame,:,:])
-        first_skeleton, first_skeleton_object = skeletonization(mask_c_1[0,:,:])
-        io.imsave(f'{args.filename}_skeletonized.tiff', skeleton)
-    if(args.v): display_single(skeleton, 'skeletonize', args.filename, '3_1', workDir, 'gray')
-
-    angle, coordinates, growing_forward = get_growth_direction(first_skeleton_object, skeleton_object)
-    if(not args.a):
-        print("[3.2] skeleton extrapolation")
-        if(args.f > 0):
-            if(args.f >= 1): interpolation_size = coordinates.shape[0] - 1
-            else: interpolation_size = int(coordinates.shape[0] * args.f)
-            extrapolation = extrapolate(skeleton, interpolation_size, args.e, angle, coordinates)
-            extended_skeleton = Skeleton(np.logical_or(skeleton, extrapolation)) # extrapolation + skeleton
-            if(args.v): display_single(np.logical_or(skeleton, extrapolation), 'extrapolate', args.filename, '3_2', workDir, 'gray')
+    with recorder.stage('skeletonization', n_frames if args.a else 2):
+        skeletons_key = cache.key('skeletons', isolation_key, {'complete_skeletonization': args.a, 'midline': args.midline})
+        skeletonized = cache.load(skeletons_key)
+        if(args.a):
+            if(skeletonized is None):
+                skeleton_timelapse, skeleton_coordinates = skeletonize_all_frames(mask_c_1, args.workers, args.midline)    # skeletonizes all frames
+                cache.store(skeletons_key, {'skeleton_timelapse': skeleton_timelapse, **pack_skeletons(skeleton_coordinates)})
+            else:
+                skeleton_timelapse, skeleton_coordinates = skeletonized['skeleton_timelapse'], unpack_skeletons(skeletonized)
+            skeleton, skeleton_object = skeleton_timelapse[last_frame], skeleton_coordinates[last_frame]
+            first_skeleton, first_skeleton_object = skeleton_timelapse[0], skeleton_coordinates[0]
         else:
-            extended_skeleton = skeleton_object
+            if(skeletonized is None):
+                skeleton, skeleton_object = skeletonization(mask_c_1[last_frame,:,:], args.midline)
+                first_skeleton, first_skeleton_object = skeletonization(mask_c_1[0,:,:], args.midline)
+                cache.store(skeletons_key, {'skeleton': skeleton, 'first_skeleton': first_skeleton, **pack_skeletons([first_skeleton_object, skeleton_object])})
+            else:
+                skeleton, first_skeleton = skeletonized['skeleton'], skeletonized['first_skeleton']
+                first_skeleton_object, skeleton_object = unpack_skeletons(skeletonized)
+        if(args.v): writer.render(display_single, skeleton, 'skeletonize', args.filename, '3_1', workDir, 'gray')
+    with recorder.stage('write_skeleton'):
+        if(args.a): writer.stack('skeletonized', skeleton_timelapse.astype(np.uint8)) # exports skeleton timelapse
+        else: writer.stack('skeletonized', skeleton)
+
+    with recorder.stage('extrapolation'):
+        angle, coordinates, growing_forward = get_growth_direction(first_skeleton_object, skeleton_object)
+        if(not args.a):
+            print("[3.2] skeleton extrapolation")
+            extended_skeleton, ray = extend_skeleton(skeleton, skeleton_object, angle, coordinates, args.f, args.e, growing_forward, args.extrapolation_model)
+            if(args.v and ray is not None):
+                extended_image = skeleton.copy() # extrapolation + skeleton
+                extended_image[ray[:,0], ray[:,1]] = True
+                writer.render(display_single, extended_image, 'extrapolate', args.filename, '3_2', workDir, 'gray')
+
+    # region of interest: the c_0 median, the ratio and its kymograph are computed only around the cell
+    # the box covers the mask of every frame and the extrapolated midline, padded so that the median and kymograph
+    # kernels read the same pixels as in the full frame
+    ratio_c_1, ratio_mask, ratio_signal = median_c_1, mask_c_1, signal_c_1
+    midline_c_0, midline_ratio = (extended_skeleton, skeleton_object) if not args.a else (skeleton_coordinates, skeleton_coordinates)
+    if(crop_c_0):
+        with recorder.stage('roi', n_frames):
+            roi = roi_bounds(mask_c_1, extended_skeleton.coordinates if not args.a else np.zeros((0, 2)), args.roi_margin + MEDIAN_HALO + 1 + args.k // 2 + args.lw // 2)
+            y0, y1, x0, x1 = roi
+            print(f'[3.3] region of interest y {y0}:{y1} x {x0}:{x1}, {100 * (y1 - y0) * (x1 - x0) / np.prod(mask_c_1.shape[1:]):.1f}% of the frame')
+            median_c_0 = median_stream(c_0[:, y0:y1, x0:x1], chunk_size, footprint=args.footprint)
+            ratio_c_1, ratio_mask, ratio_signal = median_c_1[:, y0:y1, x0:x1], mask_c_1[:, y0:y1, x0:x1], signal_c_1.crop(roi)
+            if(not args.a): midline_c_0, midline_ratio = crop_skeleton(extended_skeleton, roi), crop_skeleton(skeleton_object, roi)
+            else: midline_c_0 = midline_ratio = [crop_skeleton(skeleton_coordinates_frame, roi) for skeleton_coordinates_frame in skeleton_coordinates]
 
     # 4 KYMOGRAPH
     print("[4] kymograph generation")
-    shifted_turbo_cmap = generate_cmap(args.sf)
-    if(not args.a):
-        kymograph_c_1 = kymograph(median_c_1, extended_skeleton.coordinates, args.k, growing_forward)
-        if(hasTwoChannels): kymograph_c_0 = kymograph(median_c_0, extended_skeleton.coordinates, args.k, growing_forward)
-    else:
-        kymograph_c_1 = kymograph_framewise(median_c_1, skeleton_coordinates, args.k, growing_forward)
-        if(hasTwoChannels): kymograph_c_0 = kymograph_framewise(median_c_0, skeleton_coordinates, args.k, growing_forward)
-
-    # output
-    if(not args.a): cmap = plt.cm.turbo
+    with recorder.stage('kymograph', n_frames):
+        if(not args.a):
+            kymograph_c_1 = kymograph(median_c_1, extended_skeleton.coordinates, args.k, growing_forward, args.lw)
+            if(hasTwoChannels): kymograph_c_0 = kymograph(median_c_0, midline_c_0.coordinates, args.k, growing_forward, args.lw)
+        else:
+            kymograph_c_1 = kymograph_framewise(median_c_1, skeleton_coordinates, args.k, growing_forward, args.lw)
+            if(hasTwoChannels): kymograph_c_0 = kymograph_framewise(median_c_0, midline_c_0, args.k, growing_forward, args.lw)
+
+    # output, the colormaps are only built when previews are written
+    shifted_turbo_cmap = generate_cmap(args.sf) if writer.writes_previews else None
+    if(not args.a): cmap = 'turbo'
     else: cmap = shifted_turbo_cmap
 
-    if(args.v): display_single(kymograph_c_1, 'kymograph', args.filename, '4', workDir, 'turbo')
-    plt.imsave(f'{args.filename}_kymograph_c_1.png', kymograph_c_1, cmap=cmap)
-    np.savetxt(f"{args.filename}_kymograph_c_1.csv", kymograph_c_1, delimiter=",")
-    if(hasTwoChannels):
-        plt.imsave(f'{args.filename}_kymograph_c_0.png', kymograph_c_0, cmap=cmap)
-        np.savetxt(f"{args.filename}_kymograph_c_0.csv", kymograph_c_0, delimiter=",")
+    with recorder.stage('write_kymographs'):
+        if(args.v): writer.render(display_single, kymograph_c_1, 'kymograph', args.filename, '4', workDir, 'turbo')
+        writer.image('kymograph_c_1', kymograph_c_1, cmap)
+        writer.table('kymograph_c_1', kymograph_c_1)
+        if(hasTwoChannels):
+            writer.image('kymograph_c_0', kymograph_c_0, cmap)
+            writer.table('kymograph_c_0', kymograph_c_0)
 
     # 5 RATIOMETRIC IMAGE
     print("[5] ratiometric results")
     if(hasTwoChannels):
-        ratio, masked_ratio = ratiometric(median_c_0, median_c_1, signal_c_1, mask_c_1, thresh_c_1, args.sm, args.o, args.r)
-        if(args.b): io.imsave(f'{args.filename}_ratiometric.tiff', ratio)
-        else: io.imsave(f'{args.filename}_ratiometric.tiff', masked_foreground(ratio, mask_c_1))
+        with recorder.stage('ratiometric', n_frames):
+            ratiometric_key = cache.key('ratiometric', [filters_key, isolation_key], {'reject_outliers': args.o, 'switch_ratio': args.r, 'engine': args.engine, 'precision': args.precision, **({'roi': [int(bound) for bound in roi]} if crop_c_0 else {})})
+            ratiometric_results = cache.load(ratiometric_key)
+            if(ratiometric_results is None):
+                if(args.engine == 'legacy'): ratio, masked_ratio = ratiometric(median_c_0, ratio_c_1, ratio_signal, ratio_mask, thresh_c_1, args.sm, args.o, args.r)
+                else: ratio, masked_ratio = ratiometric_vectorized(median_c_0, ratio_c_1, ratio_signal, ratio_mask, thresh_c_1, args.sm, args.o, args.r, dtype)
+                cache.store(ratiometric_key, {'ratio': ratio})
+            else:
+                ratio = ratiometric_results['ratio'] # smoothing (--sm) only affects the masked ratio, unused below
+        with recorder.stage('write_ratiometric'):
+            if(args.b): writer.stack('ratiometric', ratio.copy()) # the ratio is masked in place below
+            elif(crop_c_0): writer.stack('ratiometric', uncrop(masked_foreground(ratio, ratio_mask), roi, mask_c_1.shape[1:])) # full frame output
+            else: writer.stack('ratiometric', masked_foreground(ratio, mask_c_1))
+
+        with recorder.stage('kymograph_ratio', n_frames):
+            if(not args.a): kymograph_ratio = kymograph(masked_foreground(ratio, ratio_mask), midline_ratio.coordinates, args.k, growing_forward, args.lw)
+            else: kymograph_ratio = kymograph_framewise(masked_foreground(ratio, ratio_mask), midline_ratio, args.k, growing_forward, args.lw)
 
-        if(not args.a): kymograph_ratio = kymograph(masked_foreground(ratio, mask_c_1), skeleton_object.coordinates, args.k, growing_forward)
-        else: kymograph_ratio = kymograph_framewise(masked_foreground(ratio, mask_c_1), skeleton_coordinates, args.k, growing_forward)
+        with recorder.stage('write_kymograph_ratio'):
+            writer.image('kymograph_ratio', kymograph_ratio, shifted_turbo_cmap)
+            writer.table('kymograph_ratio', kymograph_ratio)
 
-        plt.imsave(f'{args.filename}_kymograph_ratio.png', kymograph_ratio, cmap=shifted_turbo_cmap)
-        np.savetxt(f"{args.filename}_kymograph_ratio.csv", kymograph_ratio, delimiter=",")
\ No newline at end of file
+    with recorder.stage('write_container'):
+        writer.metadata(filename=args.filename, arguments=vars(args), shape=im.shape, angle=angle, growing_forward=growing_forward)
+        writer.close()
+
+    if(args.report is not None): recorder.write(args.report, filename=args.filename, arguments=vars(args))
+
+
+if __name__ == "__main__":
+    run(build_parser().parse_args())
@@ -3,60 +3,292 @@
 import numpy as np
 
 # image processing
-from skan import Skeleton
-from scipy import interpolate, ndimage
+# skan, loess, scipy.interpolate and matplotlib are only imported by the features that use them
+from scipy import ndimage
 from skimage import filters
-from loess.loess_1d import loess_1d
 from skimage.morphology import skeletonize
-from skimage.measure import label, regionprops
+from skimage.util import img_as_float, img_as_float32
+from numpy.lib.stride_tricks import sliding_window_view
+
+# repository
+import instrumentation
+from parallel import map_frames
+from instrumentation import instrumented
+
+# Dtype Policy
+# binary masks and skeletons are boolean, floating point intermediates default to float32
+# float64 reproduces the original double precision results and is kept for precision checks
+PRECISIONS = {'float32': np.float32, 'float64': np.float64}
+
+# Preprocessing
+# footprints: '3d' filters mix neighbouring frames (3x3x3 median, gaussian along time too), '2d' filters every frame alone
+# the 3-D filters read a halo of frames on both sides of each chunk so the results match a single pass over the
+# whole timelapse, the 2-D filters need no halo
+FOOTPRINTS = ('3d', '2d')
+MEDIAN_HALO = 1 # median footprint radius, 3x3x3 or 3x3
+MEDIAN_BLOCK = 1 << 20 # bytes of gathered neighbourhoods per median block
+
+def median_halo(footprint='3d'):
+    return MEDIAN_HALO if footprint == '3d' else 0
+
+def gaussian_halo(sigma, footprint='3d', truncate=4.0):
+    return int(truncate * sigma + 0.5) if footprint == '3d' else 0 # gaussian kernel radius along time
+
+# frames read on each side of a chunk by the median and gaussian filters
+def filter_halo(sigma, footprint='3d'):
+    return gaussian_halo(sigma, footprint) + median_halo(footprint)
+
+# Exact median filter with 'nearest' borders, same output as filters.median with its default footprint
+# the 27 (3-D) or 9 (2-D) neighbours of a block of rows are gathered side by side and partitioned at their middle,
+# a fixed cost per pixel instead of the generic ndimage selection
+def median_filter(image, footprint='3d', median_image=None):
+    image = np.asarray(image)
+    if(median_image is None): median_image = np.empty(image.shape, image.dtype)
+    depth = 2 * median_halo(footprint) + 1
+    window = (depth, 2 * MEDIAN_HALO + 1, 2 * MEDIAN_HALO + 1)
+    n_neighbours, width = np.prod(window), image.shape[2]
+    middle = n_neighbours // 2
+    padded = np.pad(image, ((depth // 2, depth // 2), (MEDIAN_HALO, MEDIAN_HALO), (MEDIAN_HALO, MEDIAN_HALO)), mode='edge')
+    rows = max(1, min(image.shape[1], MEDIAN_BLOCK // (width * n_neighbours * image.dtype.itemsize)))
+    buffer = np.empty((rows, width) + window, image.dtype) # the windows are read-only views, partitioned in a copy
 
-# visualization
-from matplotlib import pyplot as plt
-
-# Thresholding
-def thresholding(image, n_points, estimate, verbose, workDir, filename):
+    for frame in range(image.shape[0]):
+        windows = sliding_window_view(padded[frame:frame + depth], window)[0]
+        for row in range(0, image.shape[1], rows):
+            block = windows[row:row + rows]
+            np.copyto(buffer[:block.shape[0]], block)
+            neighbours = buffer[:block.shape[0]].reshape(-1, width, n_neighbours)
+            neighbours.partition(middle, axis=2)
+            median_image[frame, row:row + rows] = neighbours[:, :, middle]
+
+    return median_image
+
+# Gaussian filter of a median chunk in a single floating point buffer, filtered in place
+# same scaling as filters.gaussian, float32 buffers when the dtype policy is float32
+def gaussian_filter(median_chunk, sigma, footprint='3d', dtype=np.float64):
+    if(dtype == np.float32): buffer = img_as_float32(median_chunk, force_copy=True)
+    else: buffer = img_as_float(median_chunk, force_copy=True)
+    ndimage.gaussian_filter(buffer, sigma=sigma if footprint == '3d' else (0, sigma, sigma), output=buffer, mode='nearest', truncate=4.0)
+    return buffer
+
+# Median filters a timelapse in frame chunks
+@instrumented
+def median_stream(image, chunk_size, median_image=None, footprint='3d'):
+    if(median_image is None): median_image = np.zeros(image.shape, image.dtype)
+    n_frames, halo = image.shape[0], median_halo(footprint)
+
+    for start in range(0, n_frames, chunk_size):
+        stop = min(start + chunk_size, n_frames)
+        lo, hi = max(0, start - halo), min(n_frames, stop + halo)
+        median_image[start:stop] = median_filter(image[lo:hi], footprint)[start-lo:stop-lo]
+
+    return median_image
+
+# Segments a timelapse in frame chunks: median filter, gaussian filter and isodata thresholding
+# only the median timelapse and the binary mask are kept, gaussian chunks are discarded unless `keep_gaussian`
+# `filtered` marks `median_image` as an already computed median timelapse
+@instrumented
+def segmentation_stream(image, sigma, chunk_size, n_points, estimate, verbose, workDir, filename, workers=1, median_image=None, keep_gaussian=False, dtype=np.float64, filtered=False, footprint='3d'):
+    if(median_image is None): median_image = np.zeros(image.shape, image.dtype)
+    mask_image = np.zeros(image.shape, dtype=bool) # binary image where foreground > thresh
+    gaussian_image = np.zeros(image.shape, dtype) if keep_gaussian else None
     threshold_values = []
-    mask_image = np.zeros(image.shape) # binary image where foreground > thresh
+    n_frames, halo, m_halo = image.shape[0], gaussian_halo(sigma, footprint), median_halo(footprint)
 
-    for frame in range(image.shape[0]): # for every timeframe
-        threshold_values.append(filters.threshold_isodata(image[frame,:,:])) # gets threshold value for each image
-        mask_image[frame,:,:] = image[frame,:,:] > threshold_values[frame]
+    for start in range(0, n_frames, chunk_size):
+        stop = min(start + chunk_size, n_frames)
+        g_lo, g_hi = max(0, start - halo), min(n_frames, stop + halo) # median frames read by the gaussian
+        m_lo, m_hi = max(0, g_lo - m_halo), min(n_frames, g_hi + m_halo) # input frames read by the median
 
-    if(estimate):
-        if(n_points > image.shape[0] or n_points < 3): n_points = 40 # exception handling
-        frac = n_points / len(threshold_values)
-        xout, smooth_threshold_values, wout = loess_1d(np.arange(len(threshold_values)), np.array(threshold_values), xnew=None, degree=1, frac=frac, npoints=None, rotate=False, sigy=None)
+        if(filtered): median_chunk = np.asarray(median_image[g_lo:g_hi])
+        else:
+            median_chunk = median_filter(image[m_lo:m_hi], footprint)[g_lo-m_lo:g_hi-m_lo]
+            median_image[start:stop] = median_chunk[start-g_lo:stop-g_lo]
+        gaussian_chunk = gaussian_filter(median_chunk, sigma, footprint, dtype)[start-g_lo:stop-g_lo]
+        del median_chunk # decrease ref counter
+        if(keep_gaussian): gaussian_image[start:stop] = gaussian_chunk
+
+        mask_image[start:stop], chunk_threshold_values = thresholding(gaussian_chunk, n_points, False, False, workDir, filename, workers)
+        threshold_values.extend(chunk_threshold_values)
+        del gaussian_chunk # decrease ref counter
 
-        if(verbose):
-            fig, ax = plt.subplots()
-            plt.title(f"LOESS smoothing frac={frac}")
-            plt.plot(np.arange(len(threshold_values)), smooth_threshold_values, color="#4d6edf")
-            plt.scatter(np.arange(len(threshold_values)), threshold_values, s=18, color='#31f199')
-            plt.savefig(f'{workDir}/out/{filename}_2_2_1_{"loess"}.png', dpi=300)
-            plt.show()
-            plt.close()
+    if(estimate): threshold_values = smooth_thresholds(threshold_values, n_points, verbose, workDir, filename)
 
-        return mask_image, smooth_threshold_values
+    return median_image, gaussian_image, mask_image, threshold_values
+
+# Thresholding
+@instrumented
+def thresholding(image, n_points, estimate, verbose, workDir, filename, workers=1, show=False):
+    if(workers > 1):
+        arrays, threshold_values = map_frames(threshold_chunk, {'image': image}, {'mask': (image.shape, bool)}, image.shape[0], workers)
+        mask_image = arrays['mask']
+    else:
+        threshold_values = []
+        mask_image = np.zeros(image.shape, dtype=bool) # binary image where foreground > thresh
+
+        for frame in range(image.shape[0]): # for every timeframe
+            threshold_values.append(filters.threshold_isodata(image[frame,:,:])) # gets threshold value for each image
+            mask_image[frame,:,:] = image[frame,:,:] > threshold_values[frame]
+
+    if(estimate): return mask_image, smooth_thresholds(threshold_values, n_points, verbose, workDir, filename, show)
 
     return mask_image, threshold_values
 
-# Isolates Object with Largest Area
-def isolate_largest_area(image):
-    largest_regions = []
-    for frame in range(image.shape[0]): # for every timeframe
-        labels = label(image[frame, :, :])
-        regions = regionprops(labels)
-        if(len(regions) > 1):
-            largest_region = max(regions, key=lambda region: region.area)
-            largest_regions.append(largest_region)
-            yy = largest_region.coords[:,0]
-            xx = largest_region.coords[:,1]
-            image[frame,:,:] = np.zeros(image[frame,:,:].shape)
-            image[frame, yy, xx] = 1
-        else:
-            largest_regions.append(regions[0])
+# Smooths the frame-specific threshold values via loess polynomial regression
+@instrumented
+def smooth_thresholds(threshold_values, n_points, verbose, workDir, filename, show=False):
+    from loess.loess_1d import loess_1d
+    if(n_points > len(threshold_values) or n_points < 3): n_points = 40 # exception handling
+    frac = n_points / len(threshold_values)
+    xout, smooth_threshold_values, wout = loess_1d(np.arange(len(threshold_values)), np.array(threshold_values), xnew=None, degree=1, frac=frac, npoints=None, rotate=False, sigy=None)
+
+    if(verbose): # headless, see visualization
+        from matplotlib.figure import Figure
+        from visualization import save_figure
+        fig = Figure()
+        ax = fig.subplots()
+        ax.set_title(f"LOESS smoothing frac={frac}")
+        ax.plot(np.arange(len(threshold_values)), smooth_threshold_values, color="#4d6edf")
+        ax.scatter(np.arange(len(threshold_values)), threshold_values, s=18, color='#31f199')
+        save_figure(fig, f'{workDir}/out/{filename}_2_2_1_{"loess"}.png', show)
+
+    return smooth_threshold_values
+
+# Thresholds a chunk of frames inside a worker process
+def threshold_chunk(inputs, outputs, start, stop):
+    threshold_values = []
+    for frame in range(start, stop):
+        threshold_values.append(filters.threshold_isodata(inputs['image'][frame,:,:]))
+        outputs['mask'][frame,:,:] = inputs['image'][frame,:,:] > threshold_values[-1]
+    return threshold_values
+
+# Compact stand-in for the skimage RegionProperties used by the pipeline
+class Region:
+    def __init__(self, coords):
+        self.coords = coords
+        self.area = coords.shape[0]
+
+# Compact stand-in for the skan Skeleton used by the pipeline
+# ordered: coordinates follow the midline from one endpoint to the other, instead of the raster order of skan
+class SkeletonCoordinates:
+    def __init__(self, coordinates, degrees, ordered=False):
+        self.coordinates = coordinates
+        self.degrees = degrees
+        self.ordered = ordered
+
+# Per-frame index of the largest regions: flat pixel offsets of every frame, concatenated
+# `index[frame]` gives a Region with the (row, col) coordinates in raster order, like RegionProperties.coords
+class RegionIndex:
+    def __init__(self, offsets, bounds, frame_shape):
+        self.offsets = offsets
+        self.bounds = bounds # frame offsets are offsets[bounds[frame]:bounds[frame+1]]
+        self.frame_shape = tuple(frame_shape)
+
+    @classmethod
+    def from_frames(cls, frame_offsets, frame_shape):
+        bounds = np.zeros(len(frame_offsets) + 1, dtype=np.intp)
+        bounds[1:] = np.cumsum([offsets.shape[0] for offsets in frame_offsets])
+        offsets = np.concatenate(frame_offsets).astype(np.intp) if len(frame_offsets) > 0 else np.zeros(0, np.intp)
+        return cls(offsets, bounds, frame_shape)
+
+    def frame_offsets(self, frame):
+        return self.offsets[self.bounds[frame]:self.bounds[frame+1]]
+
+    def __len__(self):
+        return self.bounds.shape[0] - 1
+
+    def __getitem__(self, frame):
+        return Region(np.column_stack(np.unravel_index(self.frame_offsets(frame), self.frame_shape)))
+
+    def __iter__(self):
+        return (self[frame] for frame in range(len(self)))
+
+    # index of the same regions inside the region of interest (y0, y1, x0, x1)
+    def crop(self, roi):
+        y0, y1, x0, x1 = roi
+        yy, xx = np.unravel_index(self.offsets, self.frame_shape)
+        return RegionIndex(np.ravel_multi_index((yy - y0, xx - x0), (y1 - y0, x1 - x0)), self.bounds, (y1 - y0, x1 - x0))
 
-    return image, largest_regions
+# Isolates Object with Largest Area
+# components are labeled with 8-connectivity, areas are counted with a bincount over the label image and ties keep the
+# first component in raster order, like the max() over regionprops
+# search_margin: searches only the bounding box of the previous frame's component padded by this many pixels, the
+# whole frame is searched again when the component found touches the border of the window
+@instrumented
+def isolate_largest_area(image, workers=1, search_margin=None):
+    if(workers > 1):
+        arrays, frame_offsets = map_frames(isolate_chunk, {'image': image}, {'mask': (image.shape, image.dtype)}, image.shape[0], workers, (search_margin,))
+        image[...] = arrays['mask']
+        return image, RegionIndex.from_frames(frame_offsets, image.shape[1:])
+
+    return image, RegionIndex.from_frames(isolate_frames(image, 0, image.shape[0], search_margin), image.shape[1:])
+
+# isolates the largest region of frames [start, stop) in place, returns their flat offsets
+def isolate_frames(image, start, stop, search_margin=None):
+    frame_offsets, previous = [], None
+    for frame in range(start, stop): # for every timeframe
+        window = search_window(previous, image.shape[1:], search_margin)
+        offsets = largest_component(image, frame, window) if window is not None else None
+        if(offsets is None): offsets = largest_component(image, frame, (0, image.shape[1], 0, image.shape[2]))
+        frame_offsets.append(offsets)
+        previous = offsets if offsets.shape[0] > 0 else None
+    return frame_offsets
+
+# bounding box of the previous region padded by `search_margin`, as (y0, y1, x0, x1)
+def search_window(previous, frame_shape, search_margin):
+    if(search_margin is None or previous is None): return None
+    yy, xx = np.unravel_index(previous, frame_shape)
+    return (max(0, yy.min() - search_margin), min(frame_shape[0], yy.max() + search_margin + 1),
+            max(0, xx.min() - search_margin), min(frame_shape[1], xx.max() + search_margin + 1))
+
+EIGHT_CONNECTIVITY = np.ones((3, 3), dtype=bool)
+
+# keeps only the largest component of `image[frame]` inside `window` and returns its flat offsets in the frame
+# returns None when the component touches a border of the window that is not a border of the frame
+def largest_component(image, frame, window):
+    y0, y1, x0, x1 = window
+    labels, n_labels = ndimage.label(image[frame, y0:y1, x0:x1], structure=EIGHT_CONNECTIVITY)
+    if(n_labels == 0):
+        if(window != (0, image.shape[1], 0, image.shape[2])): return None # the region may have left the window
+        image[frame,:,:] = 0
+        return np.zeros(0, dtype=np.intp)
+
+    areas = np.bincount(labels.ravel())
+    areas[0] = 0 # background
+    largest = labels == areas.argmax()
+
+    if((y0 > 0 and largest[0].any()) or (y1 < image.shape[1] and largest[-1].any()) or
+       (x0 > 0 and largest[:,0].any()) or (x1 < image.shape[2] and largest[:,-1].any())): return None
+
+    image[frame,:,:] = 0
+    image[frame, y0:y1, x0:x1] = largest
+    yy, xx = np.nonzero(largest)
+    return np.ravel_multi_index((yy + y0, xx + x0), image.shape[1:])
+
+# Isolates the largest regions of a chunk of frames inside a worker process
+def isolate_chunk(inputs, outputs, start, stop, search_margin=None):
+    outputs['mask'][start:stop] = inputs['image'][start:stop]
+    return isolate_frames(outputs['mask'], start, stop, search_margin)
+
+# Region of Interest
+# bounding box (y0, y1, x0, x1) of the mask over every frame and of the midline points, padded by `margin` pixels
+def roi_bounds(mask, coordinates, margin):
+    rows, cols = np.nonzero(np.any(mask, axis=0))
+    rows = np.concatenate((rows, coordinates[:,0])).astype(int)
+    cols = np.concatenate((cols, coordinates[:,1])).astype(int)
+    return (max(0, rows.min() - margin), min(mask.shape[1], rows.max() + margin + 1),
+            max(0, cols.min() - margin), min(mask.shape[2], cols.max() + margin + 1))
+
+# skeleton coordinates inside the region of interest
+def crop_skeleton(skeleton_object, roi):
+    return SkeletonCoordinates(skeleton_object.coordinates - np.array([roi[0], roi[2]]), skeleton_object.degrees)
+
+# places a cropped timelapse back in the full frame, zeros outside the region of interest
+def uncrop(image, roi, frame_shape):
+    y0, y1, x0, x1 = roi
+    full_image = np.zeros((image.shape[0],) + tuple(frame_shape), image.dtype)
+    full_image[:, y0:y1, x0:x1] = image
+    return full_image
 
 # Apply the mask on image
 def apply_mask(image, mask):
@@ -69,6 +301,7 @@ def apply_mask(image, mask):
 
     return foreground_image, background_image
 
+@instrumented
 def masked_foreground(image, mask):
     for frame in range(image.shape[0]): # for every timeframe
         image[frame,:,:] = image[frame,:,:] * mask[frame,:,:] # foreground masking
@@ -76,8 +309,9 @@ def masked_foreground(image, mask):
     return image
 
 # Subtract Intensity from image
-def subtract_intensity(image, intensity):
-    subtracted_image = np.zeros(image.shape)
+@instrumented
+def subtract_intensity(image, intensity, dtype=np.float64):
+    subtracted_image = np.zeros(image.shape, dtype)
 
     for frame in range(image.shape[0]): # for each frame
         subtracted_image[frame,:,:] = image[frame,:,:] - intensity[frame] # subtract intensity
@@ -85,22 +319,103 @@ def subtract_intensity(image, intensity):
     return subtracted_image
 
 # Skeletonization
-def skeletonize_all_frames(image):
-    skeleton_timelapse = np.zeros(image.shape)
+# method: 'path' traces the midline directly from the skeleton image, 'skan' builds the skan.Skeleton graph of every frame
+@instrumented
+def skeletonize_all_frames(image, workers=1, method='path'):
+    if(workers > 1):
+        arrays, skeleton_coordinates = map_frames(skeletonize_chunk, {'image': image}, {'skeleton': (image.shape, bool)}, image.shape[0], workers, (method,))
+        return arrays['skeleton'], skeleton_coordinates
+
+    skeleton_timelapse = np.zeros(image.shape, dtype=bool)
     skeleton_coordinates = []
 
+    midline = None
     for frame in range(image.shape[0]):
         skeleton_timelapse[frame,:,:] = skeletonize(image[frame,:,:], method='lee')
-        skeleton_coordinates.append(Skeleton(skeleton_timelapse[frame,:,:]))
+        midline = extract_midline(skeleton_timelapse[frame,:,:], method, midline) # grows the previous midline when possible
+        skeleton_coordinates.append(midline)
 
     return skeleton_timelapse, skeleton_coordinates
 
-def skeletonization(image):
+# Skeletonizes a chunk of frames inside a worker process
+def skeletonize_chunk(inputs, outputs, start, stop, method='path'):
+    skeleton_coordinates = []
+    midline = None
+    for frame in range(start, stop):
+        outputs['skeleton'][frame,:,:] = skeletonize(inputs['image'][frame,:,:], method='lee')
+        midline = extract_midline(outputs['skeleton'][frame,:,:], method, midline)
+        if(not isinstance(midline, SkeletonCoordinates)): midline = SkeletonCoordinates(midline.coordinates, midline.degrees)
+        skeleton_coordinates.append(midline)
+    return skeleton_coordinates
+
+@instrumented
+def skeletonization(image, method='path'):
     skeleton = skeletonize(image, method='lee')
 
-    return skeleton, Skeleton(skeleton)
+    return skeleton, extract_midline(skeleton, method)
+
+# Midline Extraction
+# ordered midline of a skeleton image, from the endpoint with the smaller coordinate along the dominant axis, with the
+# number of 8-connected neighbours of every pixel: the `.coordinates` and `.degrees` read from skan.Skeleton
+# skeletons that are not a single simple path (branches, loops, isolated pixels) fall back to skan.Skeleton
+# previous: midline of the previous frame, when the skeleton only grew at a tip only the new pixels are traced
+def extract_midline(skeleton, method='path', previous=None):
+    midline = trace_midline(skeleton, previous) if method == 'path' else None
+    if(midline is None):
+        from skan import Skeleton
+        if(method == 'path'): instrumentation.count('skan_fallbacks')
+        return Skeleton(skeleton)
+    return midline
+
+NEIGHBOURHOOD = [(dy, dx) for dy in (-1, 0, 1) for dx in (-1, 0, 1) if dy != 0 or dx != 0]
+
+def trace_midline(skeleton, previous=None):
+    yy, xx = np.nonzero(skeleton) # raster order
+    n_pixels = yy.shape[0]
+    if(n_pixels < 2): return None
+
+    # neighbours of every pixel, as raster indices
+    index = np.full((skeleton.shape[0] + 2, skeleton.shape[1] + 2), -1, dtype=np.intp)
+    index[yy + 1, xx + 1] = np.arange(n_pixels)
+    neighbours = np.stack([index[yy + 1 + dy, xx + 1 + dx] for dy, dx in NEIGHBOURHOOD], axis=1)
+    degrees = np.count_nonzero(neighbours >= 0, axis=1)
+    endpoints = np.flatnonzero(degrees == 1)
+    if(endpoints.shape[0] != 2 or np.any(degrees > 2)): return None # branching
+
+    neighbours = [[neighbour for neighbour in row if neighbour >= 0] for row in neighbours.tolist()]
+    path = grow_path(previous, index, neighbours, n_pixels) if getattr(previous, 'ordered', False) else None
+    if(path is None): path = walk(neighbours, [endpoints[0]], n_pixels)
+    if(path is None): return None # disconnected
+    # starts at the endpoint with the smaller coordinate along the dominant axis, the order expected by `growing_forward`
+    delta = np.abs([yy[endpoints[1]] - yy[endpoints[0]], xx[endpoints[1]] - xx[endpoints[0]]])
+    start = endpoints[0] if (delta[1] >= delta[0] and xx[endpoints[0]] <= xx[endpoints[1]]) or delta[1] < delta[0] else endpoints[1]
+    if(path[0] != start): path = path[::-1]
+
+    path = np.array(path)
+    return SkeletonCoordinates(np.stack((yy[path], xx[path]), axis=1), degrees[path].astype(np.int32), ordered=True)
+
+# follows the skeleton from the end of `path` until it holds `n_pixels` pixels, None when it stops before
+def walk(neighbours, path, n_pixels):
+    previous, current = (path[-2] if len(path) > 1 else -1), path[-1]
+    while(len(path) < n_pixels):
+        following = [neighbour for neighbour in neighbours[current] if neighbour != previous]
+        if(len(following) != 1): return None
+        previous, current = current, following[0]
+        path.append(current)
+    return path
+
+# extends the previous midline through the pixels added at either of its ends
+def grow_path(previous, index, neighbours, n_pixels):
+    coordinates = previous.coordinates
+    path = index[coordinates[:,0] + 1, coordinates[:,1] + 1]
+    if(np.any(path < 0) or path.shape[0] > n_pixels): return None # the previous pixels moved
+    path = path.tolist()
+    if(len(path) == n_pixels): return path
+    grown = walk(neighbours, list(path), n_pixels) # grown at the last end
+    return grown if grown is not None else walk(neighbours, path[::-1], n_pixels)
 
 # Gets direction information from skeletons
+@instrumented
 def get_growth_direction(first_skeleton_object, last_skeleton_object):
 
     # get the distance between endpoints: defines grow direction
@@ -132,51 +447,71 @@ def get_growth_direction(first_skeleton_object, last_skeleton_object):
     return angle, coordinates, growing_forward
 
 # Extrapolate Skeleton based on the direction
-def extrapolate(skeleton, interpolation_size, extension, angle, coordinates):
-    x, y = coordinates.T # transpose, then unpack [vertical, horizontal]
-
-    # extract points from the growing tip
-    x_cut = x[-interpolation_size:] # vertical
-    y_cut = y[-interpolation_size:] # horizontal
-
-    # linear interpolation
-    edges_x = [x_cut[0], x_cut[-1]] # vertical
-    edges_y = [y_cut[0], y_cut[-1]] # horizontal
-    if(angle <= 45 or angle >= 135):  f = interpolate.interp1d(edges_y, edges_x, kind='linear', fill_value='extrapolate') # generates extrapolation function for horizontal growth
-    elif(angle > 45 and angle < 135): f = interpolate.interp1d(edges_x, edges_y, kind='linear', fill_value='extrapolate') # generates extrapolation function for vertical growth
-
-    extrapolation = np.zeros(skeleton.shape)
-    if(angle <= 45 or angle >= 135):
-        skeleton_tip = int(y[y.shape[0]-1])
-        if(y[y.shape[0]-1] - y[0] >= 0): growing_forward = True
-        else: growing_forward = False
-    elif(angle > 45 and angle < 135):
-        skeleton_tip = int(x[x.shape[0]-1])
-        if(x[x.shape[0]-1] - x[0] >= 0): growing_forward = True
-        else: growing_forward = False
-
+# fits the last `interpolation_size` midline points along the growth axis and returns the pixels of the ray from the
+# growing tip, `extension` pixels long or up to the image border (-1), as an (N, 2) [vertical, horizontal] array
+# ordered along the growth axis; pixels outside the image are clipped on both axes
+# model: 'endpoints' (line through the first and last points), 'lstsq' (least squares line over every point) or
+# 'spline' (smoothing spline)
+EXTRAPOLATION_MODELS = ('endpoints', 'lstsq', 'spline')
+
+@instrumented
+def extrapolate(shape, interpolation_size, extension, angle, coordinates, growing_forward, model='endpoints'):
+    horizontal = angle <= 45 or angle >= 135
+    axis = 1 if horizontal else 0 # growth axis, the other coordinate is a function of it
+    along, across = coordinates[-interpolation_size:, axis], coordinates[-interpolation_size:, 1 - axis]
+
+    # ray positions along the growth axis
+    skeleton_tip = int(coordinates[-1, axis])
     if(growing_forward):
-        if(extension == -1):
-            if(angle <= 45 or angle >= 135):
-                extension = (skeleton.shape[1] - skeleton_tip) - 1 # extends to edge [skeleton_tip -> image.shape]
-            elif(angle > 45 and angle < 135):
-                extension = (skeleton.shape[0] - skeleton_tip) - 1 # extends to edge [skeleton_tip -> image.shape]
-        for i in range(skeleton_tip+1, skeleton_tip+extension): # extends [extension] pixels from skeleton tip in `forward` direction
-            if(angle <= 45 or angle >= 135):
-                if(int(f(i)) < extrapolation.shape[1]): extrapolation[int(f(i)), i] = 1
-            elif(angle > 45 and angle < 135):
-                if(int(f(i)) < extrapolation.shape[1]): extrapolation[i, int(f(i))] = 1
-            else: break
+        if(extension == -1): extension = (shape[axis] - skeleton_tip) - 1 # extends to edge [skeleton_tip -> image.shape]
+        positions = np.arange(skeleton_tip + 1, skeleton_tip + extension)
     else:
         if(extension == -1): extension = skeleton_tip # extends to edge [0 -> skeleton_tip]
-        for i in range(skeleton_tip-extension, skeleton_tip): # extends [extension] pixels from skeleton tip in 'backward' direction
-            if(angle <= 45 or angle >= 135):
-                if(int(f(i)) >= 0 and int(f(i)) < extrapolation.shape[1]): extrapolation[int(f(i)), i] = 1
-            elif(angle > 45 and angle < 135):
-                if(int(f(i)) >= 0 and int(f(i)) < extrapolation.shape[1]): extrapolation[i, int(f(i))] = 1
-            else: break
-
-    return extrapolation
+        positions = np.arange(skeleton_tip - extension, skeleton_tip)
+
+    values = fit_ray(along, across, positions, model)
+    if(values is None): return np.zeros((0, 2), dtype=int)
+    values = np.trunc(values) # same rounding as int()
+
+    valid = np.isfinite(values) & (values >= 0) & (values < shape[1 - axis]) & (positions >= 0) & (positions < shape[axis])
+    ray = np.zeros((np.count_nonzero(valid), 2), dtype=int)
+    ray[:, axis], ray[:, 1 - axis] = positions[valid], values[valid]
+    return ray
+
+# evaluates the fitted midline at `positions`, None when the points do not define a fit
+def fit_ray(along, across, positions, model):
+    from scipy import interpolate
+    if(np.ptp(along) == 0): return None
+    if(model == 'endpoints'):
+        f = interpolate.interp1d([along[0], along[-1]], [across[0], across[-1]], kind='linear', fill_value='extrapolate')
+        return f(positions)
+    elif(model == 'lstsq'):
+        return np.polyval(np.polyfit(along, across, 1), positions)
+    elif(model == 'spline'):
+        knots, inverse = np.unique(along, return_inverse=True) # averages the points sharing a position
+        means = np.bincount(inverse, across) / np.bincount(inverse)
+        spline = interpolate.UnivariateSpline(knots, means, k=min(3, knots.shape[0] - 1), s=knots.shape[0])
+        return spline(positions)
+    raise Exception(f'Extrapolation model {model} not recognized.')
+
+# Extends the midline from its growing tip using the last `fraction` of the midline
+# returns the extended midline and the extrapolated ray, or the unchanged midline and None when fraction is 0
+# ordered midlines are joined with the ray at the growing end, other midlines keep the raster order of skan
+def extend_skeleton(skeleton, skeleton_object, angle, coordinates, fraction, extension, growing_forward, model='endpoints'):
+    if(fraction <= 0): return skeleton_object, None
+    if(fraction >= 1): interpolation_size = coordinates.shape[0] - 1
+    else: interpolation_size = int(coordinates.shape[0] * fraction)
+    ray = extrapolate(skeleton.shape, interpolation_size, extension, angle, coordinates, growing_forward, model)
+    ray = ray[~skeleton[ray[:,0], ray[:,1]]] # pixels already on the skeleton
+
+    if(getattr(skeleton_object, 'ordered', False)):
+        extended = np.concatenate((skeleton_object.coordinates, ray) if growing_forward else (ray, skeleton_object.coordinates))
+    else:
+        flat = np.union1d(np.ravel_multi_index(skeleton_object.coordinates.T, skeleton.shape), np.ravel_multi_index(ray.T, skeleton.shape))
+        extended = np.stack(np.unravel_index(flat, skeleton.shape), axis=1)
+    degrees = np.full(extended.shape[0], 2, dtype=np.int32)
+    degrees[[0, -1]] = 1
+    return SkeletonCoordinates(extended, degrees, ordered=getattr(skeleton_object, 'ordered', False)), ray
 
 # creates gaussian kernel with side length `l` and a sigma of `sig`
 # https://stackoverflow.com/a/43346070
@@ -186,48 +521,86 @@ def gkern(l, sig):
     kernel = np.outer(gauss, gauss)
     return kernel / np.sum(kernel)
 
+# unit vectors perpendicular to a midline, estimated from the neighbouring midline points
+def midline_normals(coordinates):
+    if(coordinates.shape[0] < 2): return np.zeros(coordinates.shape)
+    tangent = np.gradient(coordinates.astype(float), axis=0)
+    length = np.linalg.norm(tangent, axis=1, keepdims=True)
+    tangent = np.divide(tangent, length, out=np.zeros(tangent.shape), where=length!=0)
+    return np.stack((-tangent[:,1], tangent[:,0]), axis=1) # [vertical, horizontal]
+
+# samples the gaussian-weighted intensity of `image` only at the midline points
+# equals reading `ndimage.convolve(image[frame], kernel, mode='nearest')` at each point, without convolving the whole frame
+# frames: (N,) frame of each point, coordinates: (N, 2) [vertical, horizontal]
+# line widths wider than one pixel average the samples taken perpendicular to the midline
+def sample_midline(image, frames, coordinates, kernel, line_width=1, normals=None):
+    half_y, half_x = kernel.shape[0] // 2, kernel.shape[1] // 2
+    last_y, last_x = image.shape[1] - 1, image.shape[2] - 1
+
+    if(line_width > 1): offsets = np.arange(line_width) - (line_width - 1) / 2. # perpendicular offsets
+    else: offsets = np.zeros(1)
+
+    samples = np.zeros(frames.shape[0])
+    for offset in offsets:
+        if(offset == 0): yy, xx = coordinates[:,0].astype(int), coordinates[:,1].astype(int)
+        else:
+            yy = np.clip(np.floor(coordinates[:,0] + offset * normals[:,0] + .5), 0, last_y).astype(int) # rounds half up, the same after a crop shift
+            xx = np.clip(np.floor(coordinates[:,1] + offset * normals[:,1] + .5), 0, last_x).astype(int)
+
+        weighted = np.zeros(frames.shape[0])
+        for i in reversed(range(kernel.shape[0])): # same neighbourhood, order and 'nearest' border handling as ndimage.convolve
+            sy = np.clip(yy - i + half_y, 0, last_y)
+            for j in reversed(range(kernel.shape[1])):
+                sx = np.clip(xx - j + half_x, 0, last_x)
+                weighted += kernel[i, j] * image[frames, sy, sx]
+        if(np.issubdtype(image.dtype, np.integer)): weighted = np.trunc(weighted) # ndimage.convolve keeps the image dtype
+        samples += weighted
+
+    return samples / offsets.shape[0]
+
 # generates kymograph
-def kymograph(image, coordinates, kernel_size, growing_forward):
+@instrumented
+def kymograph(image, coordinates, kernel_size, growing_forward, line_width=1):
     kernel = gkern(kernel_size, 1) # default: 3x3 gaussian kernel
 
     coordinates = coordinates[1:] # removes skans 0 index
-    kymograph = np.zeros((image.shape[0], coordinates.shape[0])) # shape is last skeleton size (horizontal) and number of frames (vertical)
+    if(not growing_forward): coordinates = coordinates[::-1] # reversed skeleton
+    normals = midline_normals(coordinates) if line_width > 1 else None
 
-    for frame in range(image.shape[0]): # for each frame
-        gaussian = ndimage.convolve(image[frame,:,:], kernel, mode='nearest', cval=0.0) # convolves image and 3x3 gaussian kernel
-        if growing_forward:
-            for idx_x, coordinate in enumerate(coordinates): # iterates skeleton
-                kymograph[frame, idx_x] = (gaussian[int(coordinate[0]), int(coordinate[1])])
-        else:
-            for idx_x, coordinate in enumerate(reversed(coordinates)): # iterates reversed skeleton
-                kymograph[frame, idx_x] = (gaussian[int(coordinate[0]), int(coordinate[1])])
+    # every frame samples the same skeleton: shape is number of frames (vertical) and last skeleton size (horizontal)
+    n_frames, n_points = image.shape[0], coordinates.shape[0]
+    frames = np.repeat(np.arange(n_frames), n_points)
+    coordinates = np.tile(coordinates, (n_frames, 1))
+    if(normals is not None): normals = np.tile(normals, (n_frames, 1))
 
-    return kymograph
+    return sample_midline(image, frames, coordinates, kernel, line_width, normals).reshape(n_frames, n_points)
 
 # generates framewise kymograph
-def kymograph_framewise(image, coordinates_timelapse, kernel_size, growing_forward):
+@instrumented
+def kymograph_framewise(image, coordinates_timelapse, kernel_size, growing_forward, line_width=1):
     kernel = gkern(kernel_size, 1) # default: 3x3 gaussian kernel
 
-    longest_skeleton = 0
+    skeletons = []
     for coordinates in coordinates_timelapse:
-        coordinates = coordinates.coordinates[1:]
-        if (len(coordinates) > longest_skeleton): longest_skeleton = len(coordinates)
-
-    kymograph = np.zeros((image.shape[0], longest_skeleton)) # shape is longest skeleton size (horizontal) and number of frames (vertical)
-    
-    for frame, coordinates in enumerate(coordinates_timelapse): # for each frame
         coordinates = coordinates.coordinates[1:] # removes skans 0 index
-        gaussian = ndimage.convolve(image[frame,:,:], kernel, mode='nearest', cval=0.0) # convolves image and 3x3 gaussian kernel
-        if growing_forward:
-            for idx_x, coordinate in enumerate(coordinates): # iterates skeleton
-                kymograph[frame, idx_x] = (gaussian[int(coordinate[0]), int(coordinate[1])])
-        else:
-            for idx_x, coordinate in enumerate(reversed(coordinates)): # iterates reversed skeleton
-                kymograph[frame, idx_x] = (gaussian[int(coordinate[0]), int(coordinate[1])])
+        if(not growing_forward): coordinates = coordinates[::-1] # reversed skeleton
+        skeletons.append(coordinates)
+
+    # ragged skeletons are concatenated and indexed by frame and position along the midline
+    lengths = np.array([coordinates.shape[0] for coordinates in skeletons])
+    frames = np.repeat(np.arange(lengths.shape[0]), lengths)
+    columns = np.arange(frames.shape[0]) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    coordinates = np.concatenate(skeletons).reshape(-1, 2)
+    if(line_width > 1): normals = np.concatenate([midline_normals(c) for c in skeletons]).reshape(-1, 2)
+    else: normals = None
+
+    kymograph = np.zeros((image.shape[0], lengths.max(initial=0))) # shape is longest skeleton size (horizontal) and number of frames (vertical)
+    kymograph[frames, columns] = sample_midline(image, frames, coordinates, kernel, line_width, normals)
 
     return kymograph
 
 # generates ratiometric images
+@instrumented
 def ratiometric(channel_0, channel_1, signal_c_1, mask_c_1, thresh_c_1, smooth_ratio, reject_outliers, switch_ratio):
     ratio = np.zeros(channel_0.shape)
     masked_ratio = []
@@ -272,10 +645,90 @@ def ratiometric(channel_0, channel_1, signal_c_1, mask_c_1, thresh_c_1, smooth_r
                     # checks neighborhood existence
                     if(len(median) == 0): ratio[frame, y, x] = upper_whisker # saturates
                     else:
-                        q50 = np.percentile(median, [50])
+                        q50 = np.percentile(median, 50)
                         ratio[frame, y, x] = q50 # replaces with median
+                    instrumentation.count('outliers')
+
+        if(smooth_ratio): masked_ratio.append(np.ma.array(filters.median(ratio[frame,:,:]), mask = 1-mask_c_1[frame, :, :]))
+        else: masked_ratio.append(np.ma.array(ratio[frame,:,:], mask = 1-mask_c_1[frame, :, :]))
+
+    return ratio, masked_ratio
+
+# generates ratiometric images with whole-stack array operations
+# produces the same `ratio` and `masked_ratio` as `ratiometric`
+@instrumented
+def ratiometric_vectorized(channel_0, channel_1, signal_c_1, mask_c_1, thresh_c_1, smooth_ratio, reject_outliers, switch_ratio, dtype=np.float64):
+    thresh = np.asarray(thresh_c_1, dtype=dtype)[:, np.newaxis, np.newaxis] # one threshold per frame
+
+    # background threshold subtraction
+    if(switch_ratio): numerator, denominator = np.subtract(channel_0, thresh, dtype=dtype), np.subtract(channel_1, thresh, dtype=dtype)
+    else: numerator, denominator = np.subtract(channel_1, thresh, dtype=dtype), np.subtract(channel_0, thresh, dtype=dtype)
+
+    # ratio
+    ratio = np.zeros(channel_0.shape, dtype)
+    np.divide(numerator, denominator, out=ratio, where=denominator!=0)
+    del numerator # decrease ref counter
+    del denominator # decrease ref counter
+
+    masked_ratio = []
+    for frame in range(channel_0.shape[0]): # for each frame
+        # signal data extraction
+        yy = signal_c_1[frame].coords[:,0]
+        xx = signal_c_1[frame].coords[:,1]
+
+        # IQR whiskers evaluation
+        q75, q25 = np.percentile(ratio[frame, yy, xx], [75 ,25])
+        iqr = q75 - q25
+        upper_whisker = q75 + (1.5 * iqr)
+
+        if(reject_outliers): instrumentation.count('outliers', replace_outliers(ratio[frame,:,:], yy, xx, upper_whisker))
 
         if(smooth_ratio): masked_ratio.append(np.ma.array(filters.median(ratio[frame,:,:]), mask = 1-mask_c_1[frame, :, :]))
         else: masked_ratio.append(np.ma.array(ratio[frame,:,:], mask = 1-mask_c_1[frame, :, :]))
 
-    return ratio, masked_ratio
\ No newline at end of file
+    return ratio, masked_ratio
+
+# Replaces upper outliers of a single frame with their 3x3 neighbourhood median, in place
+# `ratiometric` replaces pixels one at a time in raster order, so an outlier sees the already
+# replaced values of the outliers above and to its left. Outliers are therefore replaced in
+# wavefronts: each wavefront holds the outliers whose earlier outlier neighbours are all done.
+def replace_outliers(image, yy, xx, upper_whisker):
+    outliers = image[yy, xx] > upper_whisker # region coords are in raster order
+    oy, ox = yy[outliers], xx[outliers]
+    n_outliers = oy.shape[0]
+    if(n_outliers == 0): return 0
+
+    # neighbourhood coordinates, out of bounds neighbours are flagged
+    dy, dx = np.mgrid[-1:2, -1:2]
+    ny = oy[:, np.newaxis] + dy.ravel()
+    nx = ox[:, np.newaxis] + dx.ravel()
+    valid = (ny >= 0) & (ny < image.shape[0]) & (nx >= 0) & (nx < image.shape[1])
+    ny, nx = np.where(valid, ny, 0), np.where(valid, nx, 0)
+
+    # dependencies: outliers among the neighbours preceding each outlier in raster order
+    outlier_index = np.full(image.shape, -1)
+    outlier_index[oy, ox] = np.arange(n_outliers)
+    earlier = np.flatnonzero((dy.ravel() < 0) | ((dy.ravel() == 0) & (dx.ravel() < 0)))
+    dependencies = np.where(valid[:, earlier], outlier_index[ny[:, earlier], nx[:, earlier]], -1)
+
+    done = np.zeros(n_outliers + 1, dtype=bool) # last entry stands for `no dependency`
+    done[-1] = True
+    pending = np.ones(n_outliers, dtype=bool)
+    while(pending.any()):
+        ready = pending & done[dependencies].all(axis=1)
+        rows = np.flatnonzero(ready)
+
+        # neighbourhood medians, border pixels have fewer neighbours
+        values = np.where(valid[rows], image[ny[rows], nx[rows]], np.nan)
+        values.sort(axis=1) # out of bounds neighbours are moved to the end
+        counts = valid[rows].sum(axis=1)
+        medians = np.empty(rows.shape[0])
+        for count in np.unique(counts):
+            same_count = counts == count
+            medians[same_count] = np.percentile(values[same_count, :count], 50, axis=1)
+
+        image[oy[rows], ox[rows]] = medians # replaces with median
+        done[rows] = True
+        pending[rows] = False
+
+    return n_outliers
@@ -0,0 +1,39 @@
+# Imports
+# utilities
+import tempfile
+import numpy as np
+
+# image processing
+import tifffile
+
+# Timelapse Reading
+# .dv and uncompressed .tiff files are memory-mapped: frames are only read from disk when accessed
+# and channel slices such as `im[:,0,:,:]` are views, not copies
+def read_timelapse(filename, mmap=True):
+    if(".dv" in filename):
+        from mrc import DVFile # dv reader
+        if(mmap): return DVFile(filename).data.squeeze() # the memmap keeps the file open
+        with DVFile(filename) as dv: return dv.asarray()
+    elif(".tiff" in filename or ".tif" in filename):
+        if(mmap):
+            try: return tifffile.memmap(filename, mode='r')
+            except ValueError: pass # compressed or fragmented image data can not be memory-mapped
+        from skimage import io
+        return np.array(io.imread(filename))
+    else:
+        raise Exception('Filetype not recognized.')
+
+# Memory Budget
+# frames processed per chunk so that the working set of the streaming stages fits in `max_memory` megabytes
+# working set per frame: input and median copies plus the float64 buffers of the gaussian filter
+# halo: frames read on each side of a chunk
+def frame_chunk_size(image, max_memory, halo=0):
+    if(max_memory is None): return image.shape[0]
+    frame_bytes = int(np.prod(image.shape[1:])) * (2 * image.dtype.itemsize + 3 * 8)
+    return int(max(1, min(image.shape[0], (max_memory * 2**20) // frame_bytes - 2 * halo)))
+
+# allocates a result timelapse, backed by an anonymous temporary file when it does not fit in the budget
+def allocate(shape, dtype, max_memory=None):
+    nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    if(max_memory is None or nbytes <= (max_memory * 2**20) // 4): return np.zeros(shape, dtype)
+    return np.memmap(tempfile.TemporaryFile(), dtype=dtype, mode='w+', shape=shape) # file is removed when released
@@ -0,0 +1,63 @@
+# utilities
+import os
+import sys
+import glob
+import time
+import argparse
+import tempfile
+import numpy as np
+
+# repository
+from pipeline import build_parser, run
+from processing import PRECISIONS
+
+# Precision Regression Check
+# runs the pipeline once per dtype policy and compares the kymograph CSVs against the float64 reference
+def run_policy(args, precision, directory):
+    policy_args = argparse.Namespace(**vars(args))
+    policy_args.filename = os.path.join(directory, os.path.basename(args.filename))
+    policy_args.precision = precision
+    policy_args.v = False
+    policy_args.output_format, policy_args.container = 'csv', 'none' # kymographs are compared as CSV tables
+    os.symlink(os.path.abspath(args.filename), policy_args.filename) # outputs are written next to the input
+    run(policy_args)
+
+    kymographs = {}
+    for csv in sorted(glob.glob(f'{policy_args.filename}_kymograph_*.csv')):
+        kymographs[csv[len(policy_args.filename) + 1:]] = np.loadtxt(csv, delimiter=",", ndmin=2)
+    return kymographs
+
+def compare(reference, kymographs, rtol, atol):
+    failures = []
+    for name, expected in reference.items():
+        if(name not in kymographs): failures.append(f'{name}: missing')
+        elif(kymographs[name].shape != expected.shape): failures.append(f'{name}: shape {kymographs[name].shape} != {expected.shape}')
+        elif(not np.allclose(kymographs[name], expected, rtol=rtol, atol=atol)):
+            failures.append(f'{name}: max abs difference {np.abs(kymographs[name] - expected).max()}')
+    return failures
+
+if __name__ == "__main__":
+    # execution time
+    ts = time.time()
+    print(f'[timestamp] {ts}')
+
+    # Argument Parsing
+    parser = build_parser()
+    parser.description = 'AMEBaS precision regression check: compares the kymographs of every dtype policy against float64.'
+    parser.add_argument("--rtol", type=float, nargs="?", default=1e-4, help='Relative tolerance of the kymograph comparison. Default is 1e-4.')
+    parser.add_argument("--atol", type=float, nargs="?", default=1e-6, help='Absolute tolerance of the kymograph comparison. Default is 1e-6.')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        results = {}
+        for precision in PRECISIONS:
+            os.mkdir(os.path.join(directory, precision))
+            results[precision] = run_policy(args, precision, os.path.join(directory, precision))
+
+    n_failed = 0
+    for precision, kymographs in results.items():
+        failures = compare(results['float64'], kymographs, args.rtol, args.atol)
+        n_failed += len(failures)
+        print(f'[{precision}]', 'within tolerance' if len(failures) == 0 else '; '.join(failures))
+
+    sys.exit(1 if n_failed else 0)
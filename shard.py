@@ -0,0 +1,305 @@
+# utilities
+import os
+import csv
+import json
+import time
+import shutil
+import socket
+import uuid
+import hashlib
+import argparse
+import threading
+import traceback
+import contextlib
+import collections
+from concurrent.futures import ProcessPoolExecutor
+
+# repository
+from pipeline import add_arguments, build_parser, option_actions, run
+from batch import collect_jobs, file_arguments
+from writers import OutputWriter
+
+# Sharded Mode
+# a queue directory on a shared filesystem that any number of workers, on any number of hosts, pull timelapses from:
+#   items/{item}.json              timelapse and its pipeline options, written once when queued
+#   leases/{item}.lease            claim of a running item, created exclusively and refreshed by its worker; it holds
+#                                  the worker name and a token unique to the claim, a worker only refreshes or removes
+#                                  the lease while it still holds its token
+#   done/{item}.json               completion record, written once the outputs are in place
+#   failed/{item}.{attempt}.json   failed or abandoned attempt, created exclusively, items are retried until more than
+#                                  --retries attempts failed
+# outputs are written to a staging directory next to the input and renamed over the `{filename}_*` outputs once the
+# run succeeds, so an item retried or run twice replaces complete outputs with complete outputs
+QUEUE_DIRECTORIES = ('items', 'leases', 'done', 'failed')
+
+def worker_name():
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+# item names are stable for a filename, so queueing the same timelapse again is a no-op
+def item_name(filename):
+    return f'{os.path.basename(filename)}-{hashlib.sha1(filename.encode()).hexdigest()[:12]}'
+
+# staging directory of the outputs of `item` run by `worker`, on the filesystem of the input so commits are renames
+def staging_directory(filename, item, worker):
+    return os.path.join(os.path.dirname(filename), f'.amebas-{item}-{worker}')
+
+# writes JSON through a temporary file and a rename, readers never see partial records
+def write_json(path, data):
+    temporary = f'{path}.{worker_name()}.tmp'
+    with open(temporary, 'w') as output: json.dump(data, output, default=str)
+    os.replace(temporary, path)
+
+# writes JSON records that must not replace an existing one, returns False when `path` exists
+def create_json(path, data):
+    temporary = f'{path}.{worker_name()}.tmp'
+    with open(temporary, 'w') as output: json.dump(data, output, default=str)
+    try: os.link(temporary, path) # complete record, fails if `path` exists
+    except FileExistsError: return False
+    finally: os.remove(temporary)
+    return True
+
+def read_json(path):
+    with open(path) as record: return json.load(record)
+
+class WorkQueue:
+    def __init__(self, directory, lease=300, retries=2):
+        self.directory = directory
+        self.lease = lease
+        self.retries = retries
+        self.tokens = {} # item -> token of the leases held by this worker
+        for name in QUEUE_DIRECTORIES: os.makedirs(os.path.join(directory, name), exist_ok=True)
+
+    def path(self, directory, name):
+        return os.path.join(self.directory, directory, name)
+
+    def enqueue(self, filename, options):
+        item = item_name(filename)
+        if(not os.path.exists(self.path('items', f'{item}.json'))): write_json(self.path('items', f'{item}.json'), {'filename': filename, 'options': options})
+        return item
+
+    # snapshot of the queue: items, completed items, failed attempts per item and lease modification times
+    def scan(self):
+        items = sorted(name[:-len('.json')] for name in os.listdir(os.path.join(self.directory, 'items')) if name.endswith('.json'))
+        done = {name[:-len('.json')] for name in os.listdir(os.path.join(self.directory, 'done')) if name.endswith('.json')}
+        attempts = collections.Counter(name.rsplit('.', 2)[0] for name in os.listdir(os.path.join(self.directory, 'failed')) if name.endswith('.json'))
+        leases = {}
+        for name in os.listdir(os.path.join(self.directory, 'leases')):
+            if(not name.endswith('.lease')): continue
+            try: leases[name[:-len('.lease')]] = os.stat(self.path('leases', name)).st_mtime
+            except FileNotFoundError: pass # released meanwhile
+        return items, done, attempts, leases
+
+    def expired(self, modified):
+        return time.time() - modified > self.lease
+
+    # claims the first item that is not done, has attempts left and is not leased by a live worker
+    # returns None when no item can be claimed right now
+    def claim(self, worker):
+        items, done, attempts, leases = self.scan()
+        for item in items:
+            if(item in done or attempts[item] > self.retries): continue
+            if(item in leases):
+                if(not self.expired(leases[item]) or not self.break_lease(item, worker)): continue
+                if(attempts[item] + 1 > self.retries): continue # the abandoned attempt was the last one
+            try: descriptor = os.open(self.path('leases', f'{item}.lease'), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError: continue # claimed by another worker
+            token = f'{worker} {uuid.uuid4().hex}'
+            with os.fdopen(descriptor, 'w') as lease: lease.write(token)
+            self.tokens[item] = token
+            if(os.path.exists(self.path('done', f'{item}.json'))): # completed between the scan and the claim
+                self.release(item)
+                continue
+            return item
+        return None
+
+    # takes over the lease of a worker that stopped refreshing it, the abandoned run counts as a failed attempt
+    # and its staging directory is removed, only one worker wins the rename, a lease refreshed meanwhile is put back
+    def break_lease(self, item, worker):
+        lease, stale = self.path('leases', f'{item}.lease'), self.path('leases', f'{item}.{worker}.stale')
+        try: os.rename(lease, stale)
+        except FileNotFoundError: return False
+        if(not self.expired(os.stat(stale).st_mtime)):
+            with contextlib.suppress(FileExistsError): os.link(stale, lease)
+            os.remove(stale)
+            return False
+        with open(stale) as abandoned: owner = abandoned.read().split(' ')[0]
+        filename = read_json(self.path('items', f'{item}.json'))['filename']
+        self.fail(item, {'filename': filename, 'worker': owner, 'status': 'abandoned', 'error': f'lease expired, taken over by {worker}'})
+        shutil.rmtree(staging_directory(filename, item, owner), ignore_errors=True)
+        os.remove(stale)
+        return True
+
+    # whether the lease of `item` still holds the token of this worker's claim
+    def owns(self, item):
+        try:
+            with open(self.path('leases', f'{item}.lease')) as lease: return lease.read() == self.tokens.get(item)
+        except FileNotFoundError: return False
+
+    # refreshes the lease of `item` while the block runs, through the file that was read so that a lease taken over
+    # meanwhile is never refreshed; the heartbeat stops once the lease is lost
+    @contextlib.contextmanager
+    def holding(self, item):
+        stop = threading.Event()
+        def heartbeat():
+            while(not stop.wait(self.lease / 4)):
+                try:
+                    with open(self.path('leases', f'{item}.lease'), 'r+') as lease:
+                        if(lease.read() != self.tokens.get(item)): return
+                        os.utime(lease.fileno())
+                except FileNotFoundError: return
+        thread = threading.Thread(target=heartbeat, daemon=True)
+        thread.start()
+        try: yield
+        finally:
+            stop.set()
+            thread.join()
+
+    # removes the lease of `item` only if it is still this worker's claim, a lease taken over is put back
+    def release(self, item):
+        token = self.tokens.pop(item, None)
+        lease, released = self.path('leases', f'{item}.lease'), self.path('leases', f'{item}.{uuid.uuid4().hex}.released')
+        try: os.rename(lease, released)
+        except FileNotFoundError: return
+        with open(released) as claim:
+            if(claim.read() != token):
+                with contextlib.suppress(FileExistsError): os.link(released, lease)
+        os.remove(released)
+
+    def complete(self, item, record):
+        write_json(self.path('done', f'{item}.json'), record)
+
+    def fail(self, item, record):
+        attempt = sum(name.startswith(f'{item}.') and name.endswith('.json') for name in os.listdir(os.path.join(self.directory, 'failed'))) + 1
+        while(not create_json(self.path('failed', f'{item}.{attempt}.json'), {'attempt': attempt, 'time': time.time(), **record})): attempt += 1
+
+    # counts of done, failed (out of attempts), running and pending items
+    def status(self):
+        items, done, attempts, leases = self.scan()
+        counts = collections.Counter()
+        for item in items:
+            if(item in done): counts['done'] += 1
+            elif(attempts[item] > self.retries): counts['failed'] += 1
+            elif(item in leases and not self.expired(leases[item])): counts['running'] += 1
+            else: counts['pending'] += 1
+        return {'items': len(items), **{key: counts[key] for key in ('done', 'failed', 'running', 'pending')}}
+
+# Output Commit
+# moves the outputs of a run from its staging directory over the outputs next to the input, file by file
+def commit(staging, destination):
+    for name in sorted(os.listdir(staging)):
+        target = os.path.join(destination, name)
+        if(os.path.isdir(target)): shutil.rmtree(target) # zarr containers are directories
+        os.replace(os.path.join(staging, name), target)
+
+# Runs the pipeline on one claimed item, failures are recorded instead of raised
+# a worker whose lease was taken over discards its outputs, the item belongs to the worker that took it over
+def process(queue, item, worker):
+    entry = read_json(queue.path('items', f'{item}.json'))
+    filename = entry['filename']
+    args = build_parser().parse_args([filename]) # defaults of options added after the item was queued
+    vars(args).update(entry['options'])
+    staging = staging_directory(filename, item, worker)
+    ts = time.time()
+    try:
+        os.makedirs(staging, exist_ok=True)
+        with queue.holding(item):
+            run(args, writer=OutputWriter(os.path.join(staging, os.path.basename(filename)), args.output_format, args.container, args.write_buffer * 1024**2))
+            if(queue.owns(item)): commit(staging, os.path.dirname(filename))
+        if(queue.owns(item)):
+            queue.complete(item, {'filename': filename, 'worker': worker, 'started': ts, 'finished': time.time(), 'seconds': round(time.time() - ts, 3)})
+            status = 'ok'
+        else:
+            print(f'[shard] {worker}: lease of {item} was taken over, outputs discarded')
+            status = 'lost'
+    except Exception as exception:
+        traceback.print_exc()
+        if(queue.owns(item)):
+            queue.fail(item, {'filename': filename, 'worker': worker, 'status': 'failed', 'seconds': round(time.time() - ts, 3), 'error': f'{type(exception).__name__}: {exception}'})
+            status = 'failed'
+        else: status = 'lost' # the staging directory was removed by the worker that took the item over
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+        queue.release(item)
+    return status
+
+# Pulls items until the queue holds nothing this worker can claim and no live worker may still fail an item
+def work(directory, lease, retries, poll):
+    queue, worker = WorkQueue(directory, lease, retries), worker_name()
+    ts, results = time.time(), collections.Counter()
+    while(True):
+        item = queue.claim(worker)
+        if(item is None):
+            if(queue.status()['running'] == 0): break
+            time.sleep(poll) # items leased by other workers are retried here if they are abandoned
+            continue
+        results[process(queue, item, worker)] += 1
+        status = queue.status()
+        elapsed = time.time() - ts
+        print(f"[shard] {worker}: {status['done']}/{status['items']} done, {status['failed']} failed, {status['running']} running, {status['pending']} pending | this worker {sum(results.values())} items, {60 * sum(results.values()) / elapsed:.2f}/min")
+    print(f"[shard] {worker} finished: {results['ok']} succeeded, {results['failed']} failed, {results['lost']} taken over in {round(time.time() - ts, 3)}s")
+    return dict(results)
+
+# progress of the whole queue, throughput from the completion records of every worker
+def report(queue, summary_filename=None):
+    status = queue.status()
+    records = [read_json(queue.path('done', name)) for name in os.listdir(os.path.join(queue.directory, 'done')) if name.endswith('.json')]
+    line = f"[shard] {status['done']}/{status['items']} done, {status['failed']} failed, {status['running']} running, {status['pending']} pending"
+    if(records):
+        span = max(record['finished'] for record in records) - min(record['started'] for record in records)
+        rate = 60 * len(records) / max(span, 1e-9)
+        remaining = status['running'] + status['pending']
+        line += f", {rate:.2f} items/min, {sum(record['seconds'] for record in records) / len(records):.1f}s per item"
+        if(remaining): line += f', about {remaining / rate:.1f} min left'
+    print(line)
+
+    if(summary_filename is not None):
+        items, done, attempts, leases = queue.scan()
+        with open(summary_filename, 'w', newline='') as summary:
+            writer = csv.DictWriter(summary, fieldnames=['filename', 'status', 'attempts', 'worker', 'seconds', 'error'])
+            writer.writeheader()
+            for item in items:
+                row = {'filename': read_json(queue.path('items', f'{item}.json'))['filename'], 'attempts': attempts[item]}
+                failures = sorted((name for name in os.listdir(os.path.join(queue.directory, 'failed')) if name.endswith('.json') and name.rsplit('.', 2)[0] == item), key=lambda name: int(name.rsplit('.', 2)[1]))
+                if(failures): row['error'] = read_json(queue.path('failed', failures[-1])).get('error', '')
+                if(item in done):
+                    record = read_json(queue.path('done', f'{item}.json'))
+                    row.update(status='done', worker=record['worker'], seconds=record['seconds'])
+                elif(attempts[item] > queue.retries): row['status'] = 'failed'
+                elif(item in leases and not queue.expired(leases[item])): row['status'] = 'running'
+                else: row['status'] = 'pending'
+                writer.writerow(row)
+    return status
+
+if __name__ == "__main__":
+    # Argument Parsing
+    parser = argparse.ArgumentParser(description='AMEBaS sharded mode: queues timelapses in a shared directory and processes them with any number of workers on any number of hosts. Pipeline options are stored with each queued timelapse.')
+    parser.add_argument('queue', type=str, metavar='queue', help='Queue directory, on a filesystem shared by every worker.')
+    parser.add_argument('inputs', type=str, nargs='*', metavar='input', help='Directory, glob pattern or CSV/JSON manifest to queue, as in batch mode. Timelapses already queued are skipped. Without inputs, only works on the queue.')
+    parser.add_argument("--jobs", type=int, nargs="?", default=1, help='Number of local worker processes. Default is 1.')
+    parser.add_argument("--lease", type=float, nargs="?", default=300, help='Seconds without a heartbeat after which a running timelapse is considered abandoned and is taken over by another worker. Must exceed the clock skew between hosts. Default is 300.')
+    parser.add_argument("--retries", type=int, nargs="?", default=2, help='Failed or abandoned attempts retried per timelapse. Default is 2.')
+    parser.add_argument("--poll", type=float, nargs="?", default=10, help='Seconds between queue scans while other workers hold the remaining timelapses. Default is 10.')
+    parser.add_argument("--enqueue-only", default=False, action='store_true', help='Queues the inputs and exits without working. Default is false.')
+    parser.add_argument("--status", default=False, action='store_true', help='Prints the progress and throughput of the queue and exits. Default is false.')
+    parser.add_argument("--summary", type=str, nargs="?", default=None, help='Filename of a table with the status, attempts, worker, timing and last error of every queued timelapse, written with --status. Disabled by default.')
+    add_arguments(parser)
+    args = parser.parse_args()
+    queue = WorkQueue(args.queue, args.lease, args.retries)
+
+    # queueing: per-file options are resolved once, so every worker runs a timelapse with the same options
+    if(args.inputs):
+        defaults = argparse.Namespace(**{key: value for key, value in vars(args).items() if key not in ('queue', 'inputs', 'jobs', 'lease', 'retries', 'poll', 'enqueue_only', 'status', 'summary')})
+        actions = option_actions(parser)
+        jobs = [file_arguments(defaults, actions, os.path.abspath(filename), overrides) for filename, overrides in collect_jobs(args.inputs)]
+        for job in jobs: queue.enqueue(job.filename, {key: value for key, value in vars(job).items() if key != 'filename'})
+        print(f'[shard] {len(jobs)} files queued in {args.queue}')
+
+    if(args.status): report(queue, args.summary)
+    elif(not args.enqueue_only):
+        # execution: local workers pull from the queue like workers on other hosts
+        if(args.jobs > 1):
+            with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+                list(executor.map(work, *zip(*[(args.queue, args.lease, args.retries, args.poll)] * args.jobs)))
+        else:
+            work(args.queue, args.lease, args.retries, args.poll)
+        report(queue)
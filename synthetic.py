@@ -0,0 +1,49 @@
+# Imports
+# utilities
+import numpy as np
+
+# Synthetic Timelapses
+# growing pollen tube with a known midline, used by the benchmark suite
+# direction: 'forward' (+x), 'backward' (-x), 'down' (+y) or 'up' (-y)
+DIRECTIONS = ('forward', 'backward', 'down', 'up')
+
+def synthetic_timelapse(n_frames=30, shape=(128, 192), channels=2, noise=20., direction='forward', width=8, growth=2., slope=.1, seed=0):
+    rng = np.random.default_rng(seed)
+    vertical = direction in ('down', 'up')
+    height, length = (shape[1], shape[0]) if vertical else shape # tube is drawn growing along +x, then flipped/transposed
+
+    # midline: straight ray from the base, the tip advances `growth` pixels per frame
+    base_x, base_y = int(.1 * length), height / 2. - slope * .3 * length
+    tip_x = np.minimum(base_x + .3 * length + growth * np.arange(n_frames), length - width)
+    yy, xx = np.mgrid[0:height, 0:length]
+    midline_y = base_y + slope * (xx - base_x)
+
+    clean = np.zeros((n_frames, channels, height, length))
+    midlines = []
+    for frame in range(n_frames):
+        distance = np.abs(yy - midline_y) # distance to the midline
+        tip_distance = np.hypot(xx - tip_x[frame], yy - (base_y + slope * (tip_x[frame] - base_x)))
+        tube = ((distance < width / 2.) & (xx >= base_x) & (xx <= tip_x[frame])) | (tip_distance < width / 2.)
+        tip_gradient = np.exp(-np.clip(tip_x[frame] - xx, 0, None) / 10.) # ion gradient at the growing tip
+        for channel in range(channels):
+            signal = 1000. * (1 + channel * tip_gradient) # last channel carries the gradient
+            clean[frame, channel] = 200. + tube * signal
+
+        x = np.arange(base_x, int(tip_x[frame]) + 1)
+        midlines.append(np.stack((np.rint(base_y + slope * (x - base_x)).astype(int), x), axis=1)) # [vertical, horizontal], base -> tip
+
+    # growth direction
+    if(direction in ('backward', 'up')):
+        clean = clean[..., ::-1]
+        midlines = [np.stack((m[:,0], length - 1 - m[:,1]), axis=1) for m in midlines]
+    if(vertical):
+        clean = np.swapaxes(clean, 2, 3)
+        midlines = [m[:, ::-1] for m in midlines]
+
+    timelapse = np.clip(clean + rng.normal(0, noise, clean.shape), 0, 65535).astype(np.uint16)
+    if(channels == 1): timelapse, clean = timelapse[:,0], clean[:,0]
+
+    return {'timelapse': timelapse,
+            'clean': np.ascontiguousarray(clean),
+            'midlines': midlines,
+            'growing_forward': direction in ('forward', 'down')}
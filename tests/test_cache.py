@@ -0,0 +1,33 @@
+# utilities
+import os
+import sys
+import numpy as np
+import tifffile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # repository modules
+
+# repository
+from cache import pack_skeletons, unpack_skeletons
+from processing import SkeletonCoordinates
+from pipeline import run_pipeline
+from synthetic import synthetic_timelapse
+
+# Stage Cache
+def test_skeletons_round_trip():
+    skeletons = [SkeletonCoordinates(np.array([[0, 0], [1, 1], [2, 2]]), np.array([1, 2, 1]), ordered=True),
+                 SkeletonCoordinates(np.array([[0, 0], [5, 3]]), np.array([1, 1]), ordered=False)]
+    arrays = {name: np.asarray(array) for name, array in pack_skeletons(skeletons).items()}
+    for skeleton, unpacked in zip(skeletons, unpack_skeletons(arrays)):
+        assert np.array_equal(unpacked.coordinates, skeleton.coordinates)
+        assert np.array_equal(unpacked.degrees, skeleton.degrees)
+        assert unpacked.ordered == skeleton.ordered
+
+# a rerun that reuses the skeleton stage gives the kymographs of a fresh run
+def test_cached_run_matches_uncached_run(tmp_path):
+    filename = str(tmp_path / 'backward.tiff')
+    tifffile.imwrite(filename, synthetic_timelapse(12, (64, 96), 2, 20., 'backward')['timelapse'])
+    fresh = run_pipeline(filename)
+    run_pipeline(filename, {'cache': str(tmp_path / 'cache')})
+    cached = run_pipeline(filename, {'cache': str(tmp_path / 'cache'), 'sf': .5}) # skeleton stage is a cache hit
+    for name in ('kymograph_c_1', 'kymograph_c_0'):
+        assert np.array_equal(cached[name], fresh[name])
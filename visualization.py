@@ -2,9 +2,7 @@
 # utilities
 import numpy as np
 # visualization
-import matplotlib as mpl
-from matplotlib import pyplot as plt
-from matplotlib.colors import ListedColormap
+# matplotlib is imported by the functions, so importing the module does not load it
 
 # Visualization Functions
 # Colormap Generation
@@ -12,6 +10,8 @@ from matplotlib.colors import ListedColormap
 # 70% -> purple
 # 30% -> turbo
 def generate_cmap(shift_frac):
+    import matplotlib as mpl
+    from matplotlib.colors import ListedColormap
     turbo = mpl.colormaps['turbo'].resampled(256)
     highlight_frac = 1 - shift_frac
     n_steps = 256
@@ -23,64 +23,54 @@ def generate_cmap(shift_frac):
 
     return new_turbo
 
-# Display Image Helper Function
-def display(image, title, filename, id, workDir, colorMap):
-    fig, axes = plt.subplots(nrows=1, ncols=3, sharex=True, sharey=True)
-    plt.suptitle(title, fontsize=18)
-    ax = axes.ravel()
-    if(colorMap == "turbo"): cmap = plt.cm.turbo
-    else: cmap = plt.cm.gray
+# Figure Rendering
+# figures are drawn with the object-oriented API on the Agg canvas, so they never open or block on a window
+# and can be rendered by the background writer thread while the pipeline runs
+# notebooks pass `show=True` to also display the figures inline, the figures are returned either way
+
+# saves a figure and, with `show`, displays it in the notebook output
+def save_figure(fig, path, show=False):
+    fig.savefig(path, dpi=300)
+    if(show):
+        from IPython.display import display as display_inline # notebooks only
+        display_inline(fig)
+    return fig
 
-    ax[0].imshow(image[0,:,:], cmap=cmap)
-    ax[0].axis('off')
-    ax[0].set_title("0", fontsize=14)
+# frames shown by `display`: first, middle and last
+def display_frames(n_frames):
+    return [0, int(np.floor(n_frames / 2)), n_frames - 1]
 
-    half = int(np.floor(image.shape[0] / 2))
-    ax[1].imshow(image[half,:,:], cmap=cmap)
-    ax[1].axis('off')
-    ax[1].set_title(f"{half}", fontsize=14)
+# Display Image Helper Function
+# frames: labels of the frames of `image` when it only holds the displayed frames
+def display(image, title, filename, id, workDir, colorMap, frames=None, show=False):
+    from matplotlib.figure import Figure
+    if(frames is None):
+        frames = display_frames(image.shape[0])
+        image = [image[frame,:,:] for frame in frames]
+    cmap = 'turbo' if colorMap == "turbo" else 'gray'
 
-    ax[2].imshow(image[image.shape[0]-1,:,:], cmap=cmap)
-    ax[2].axis('off')
-    ax[2].set_title(f"{image.shape[0]-1}", fontsize=14)
+    fig = Figure()
+    axes = fig.subplots(nrows=1, ncols=3, sharex=True, sharey=True)
+    fig.suptitle(title, fontsize=18)
+    for ax, panel, frame in zip(axes.ravel(), image, frames):
+        ax.imshow(panel, cmap=cmap)
+        ax.axis('off')
+        ax.set_title(f"{frame}", fontsize=14)
 
     fig.tight_layout()
-    plt.savefig(f'{workDir}/out/{filename}_{id}_{title}.png', dpi=300)
-    plt.show()
-    plt.close()
+    return save_figure(fig, f'{workDir}/out/{filename}_{id}_{title}.png', show)
 
 # Display Single Image Helper Function
-def display_single(image, title, filename, id, workDir, cmap):
-    fig, ax = plt.subplots()
+def display_single(image, title, filename, id, workDir, cmap, show=False):
+    from matplotlib.figure import Figure
+    fig = Figure()
+    ax = fig.subplots()
 
-    plt.title(title, fontsize=16)
-    ax = plt.imshow(image, cmap=cmap)
-    plt.savefig(f'{workDir}/out/{filename}_{id}_{title}.png', dpi=300)
-    plt.show()
-    plt.close()
+    ax.set_title(title, fontsize=16)
+    ax.imshow(image, cmap=cmap)
+    return save_figure(fig, f'{workDir}/out/{filename}_{id}_{title}.png', show)
 
 # Display Triple Image Helper Function
-def display_three(image, title, filename, id, workDir, colorMap):
-    fig, axes = plt.subplots(nrows=1, ncols=3, sharex=True, sharey=True)
-    plt.suptitle(title, fontsize=18)
-    ax = axes.ravel()
-    if(colorMap == "turbo"): cmap = plt.cm.turbo
-    else: cmap = plt.cm.gray
-
-    ax[0].imshow(image[0], cmap=cmap)
-    ax[0].axis('off')
-    ax[0].set_title("0", fontsize=14)
-
-    half = int(np.floor(len(image) / 2))
-    ax[1].imshow(image[half], cmap=cmap)
-    ax[1].axis('off')
-    ax[1].set_title(f"{half}", fontsize=14)
-
-    ax[2].imshow(image[len(image)-1], cmap=cmap)
-    ax[2].axis('off')
-    ax[2].set_title(f"{len(image)-1}", fontsize=14)
-
-    fig.tight_layout()
-    plt.savefig(f'{workDir}/out/{filename}_{id}_{title}.png', dpi=300)
-    plt.show()
-    plt.close()
\ No newline at end of file
+def display_three(image, title, filename, id, workDir, colorMap, show=False):
+    frames = display_frames(len(image))
+    return display([image[frame] for frame in frames], title, filename, id, workDir, colorMap, frames, show)
@@ -0,0 +1,215 @@
+# Imports
+# utilities
+import sys
+import json
+import atexit
+import threading
+import traceback
+import collections
+import numpy as np
+
+# Output Writers
+# tables: thresholds and kymographs, written as CSV (compatibility), NPY, compressed NPZ or Parquet
+# stacks: mask, skeleton and ratiometric timelapses, written as TIFF
+# a container collects every product of a run (tables, stacks and metadata) in a single compressed,
+# chunked store instead of a scatter of `{filename}_*` files
+# skimage and matplotlib are imported on the first TIFF or PNG written
+# with a write buffer, writes and figure rendering run on a background thread while the next stages compute
+TABLE_FORMATS = ('csv', 'npy', 'npz', 'parquet')
+CONTAINERS = ('none', 'npz', 'hdf5', 'zarr')
+CONTAINER_EXTENSIONS = {'npz': 'npz', 'hdf5': 'h5', 'zarr': 'zarr'}
+
+class OutputWriter:
+    # write_buffer: cap in bytes of the arrays held by queued writes, 0 writes synchronously
+    def __init__(self, filename, table_format='csv', container='none', write_buffer=0):
+        if(table_format not in TABLE_FORMATS): raise Exception(f'Table format {table_format} not recognized.')
+        if(container not in CONTAINERS): raise Exception(f'Container {container} not recognized.')
+        check_dependencies(table_format, container) # fails before the run, not on the writer thread
+        self.filename = filename
+        self.table_format = table_format
+        self.container = container
+        self.store = None
+        self.arrays = {} # npz containers are written once, on close
+        self.attributes = {}
+        self.writes_previews = container == 'none'
+        self.queue = WriteQueue(write_buffer) if write_buffer > 0 else None
+        if(container != 'none'): self.store = open_container(f'{filename}_amebas.{CONTAINER_EXTENSIONS[container]}', container)
+
+    # runs `function(*args)` on the writer thread, the arrays in `args` must not be modified afterwards
+    def submit(self, function, *args):
+        if(self.queue is None): function(*args)
+        else: self.queue.submit(function, *args)
+
+    def table(self, name, array):
+        array = np.asarray(array)
+        if(self.container != 'none'): self.submit(self.add, name, array, None)
+        else: self.submit(write_table, f'{self.filename}_{name}', array, self.table_format)
+
+    def stack(self, name, array):
+        array = np.asarray(array)
+        if(self.container != 'none'): self.submit(self.add, name, array, (1,) + array.shape[1:] if array.ndim == 3 else None)
+        else: self.submit(write_stack, f'{self.filename}_{name}.tiff', array)
+
+    # colormapped previews are only written as separate files
+    def image(self, name, array, cmap):
+        if(self.writes_previews): self.submit(write_image, f'{self.filename}_{name}.png', np.asarray(array), cmap)
+
+    # verbose figures, see visualization
+    def render(self, function, *args):
+        self.submit(function, *args)
+
+    # run metadata is only stored in containers
+    def metadata(self, **attributes):
+        self.attributes.update(attributes)
+
+    def add(self, name, array, chunks):
+        if(self.container == 'npz'): self.arrays[name] = array
+        elif(self.container == 'hdf5'): self.store.create_dataset(name, data=array, chunks=chunks, compression='gzip', shuffle=True)
+        elif(self.container == 'zarr'):
+            create = getattr(self.store, 'create_array', None) or self.store.create_dataset # zarr 3 or zarr 2
+            create(name, data=array, chunks=chunks if chunks is not None else array.shape)
+
+    # waits for the queued writes and raises if any of them failed
+    def flush(self):
+        if(self.queue is not None): self.queue.flush()
+
+    def close(self):
+        self.flush()
+        if(self.container == 'npz'):
+            np.savez_compressed(f'{self.filename}_amebas.npz', metadata=np.array(json.dumps(self.attributes, default=str)), **self.arrays)
+            self.arrays = {}
+        elif(self.container == 'hdf5'):
+            self.store.attrs['metadata'] = json.dumps(self.attributes, default=str)
+            self.store.close()
+        elif(self.container == 'zarr'):
+            self.store.attrs['metadata'] = json.dumps(self.attributes, default=str)
+        if(self.queue is not None): self.queue.close()
+
+# Background Writer
+# a writer thread runs the queued writes in submission order and exits when the queue is empty
+# `submit` blocks while the arrays held by the queued writes exceed `max_bytes`, a single larger write is queued alone
+# failures are collected and raised by `flush`, writes still queued at interpreter exit are finished and checked
+class WriteQueue:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.queued_bytes = 0
+        self.tasks = collections.deque()
+        self.pending = 0 # queued and running writes
+        self.errors = []
+        self.thread = None
+        self.condition = threading.Condition()
+        atexit.register(self.exit)
+
+    def submit(self, function, *args):
+        nbytes = sum(arg.nbytes for arg in args if isinstance(arg, np.ndarray))
+        with self.condition:
+            while(self.pending > 0 and self.queued_bytes + nbytes > self.max_bytes): self.condition.wait()
+            self.tasks.append((function, args, nbytes))
+            self.pending += 1
+            self.queued_bytes += nbytes
+            if(self.thread is None):
+                self.thread = threading.Thread(target=self.work, name='amebas-writer', daemon=True)
+                self.thread.start()
+
+    def work(self):
+        while(True):
+            with self.condition:
+                if(not self.tasks):
+                    self.thread = None
+                    return
+                function, args, nbytes = self.tasks.popleft()
+            try: function(*args)
+            except Exception: self.errors.append(traceback.format_exc())
+            with self.condition:
+                self.pending -= 1
+                self.queued_bytes -= nbytes
+                self.condition.notify_all()
+
+    def wait(self):
+        with self.condition:
+            while(self.pending > 0): self.condition.wait()
+
+    def flush(self):
+        self.wait()
+        if(self.errors):
+            errors, self.errors = self.errors, []
+            raise Exception(f'{len(errors)} output writes failed:\n' + '\n'.join(errors))
+
+    def close(self):
+        self.flush()
+        atexit.unregister(self.exit)
+
+    # outputs of runs interrupted by an exception are still written, failures are reported on stderr
+    def exit(self):
+        self.wait()
+        for error in self.errors: print(error, file=sys.stderr)
+
+# keeps the products of a run in memory instead of writing them, used by the library API
+# tables and stacks are stored by name next to the run metadata, previews are skipped
+class MemoryWriter:
+    def __init__(self):
+        self.results = {}
+        self.writes_previews = False
+
+    def table(self, name, array):
+        self.results[name] = np.asarray(array)
+
+    def stack(self, name, array):
+        self.results[name] = np.asarray(array)
+
+    def image(self, name, array, cmap):
+        pass
+
+    def render(self, function, *args):
+        function(*args)
+
+    def metadata(self, **attributes):
+        self.results.update(attributes)
+
+    def close(self):
+        pass
+
+# writes a timelapse or image as TIFF
+def write_stack(path, array):
+    from skimage import io
+    io.imsave(path, array, check_contrast=False)
+
+# writes a colormapped PNG preview, without pyplot so it is safe on the writer thread
+def write_image(path, array, cmap):
+    from matplotlib import image
+    image.imsave(path, array, cmap=cmap)
+
+# writes a 1-D or 2-D table as `{stem}.{format}`
+def write_table(stem, array, table_format):
+    if(table_format == 'csv'): np.savetxt(f'{stem}.csv', array, delimiter=",")
+    elif(table_format == 'npy'): np.save(f'{stem}.npy', array)
+    elif(table_format == 'npz'): np.savez_compressed(f'{stem}.npz', data=array)
+    elif(table_format == 'parquet'):
+        import pyarrow
+        import pyarrow.parquet
+        columns = np.atleast_2d(array.T).T if array.ndim == 1 else array # one column per kymograph position
+        table = pyarrow.table({str(column): columns[:, column] for column in range(columns.shape[1])})
+        pyarrow.parquet.write_table(table, f'{stem}.parquet', compression='zstd')
+
+# raises when the optional dependency of a table format or container is missing
+# writers check it when created, entry points that create their writers late check it before the run
+def check_dependencies(table_format, container='none'):
+    if(table_format == 'parquet' and container == 'none'):
+        try: import pyarrow.parquet
+        except ImportError: raise Exception('Parquet output requires pyarrow.')
+    if(container == 'hdf5'):
+        try: import h5py
+        except ImportError: raise Exception('HDF5 containers require h5py.')
+    elif(container == 'zarr'):
+        try: import zarr
+        except ImportError: raise Exception('Zarr containers require zarr.')
+
+# opens a chunked store, the optional dependencies are only imported when used
+def open_container(path, container):
+    if(container == 'hdf5'):
+        import h5py
+        return h5py.File(path, 'w')
+    elif(container == 'zarr'):
+        import zarr
+        return zarr.open_group(path, mode='w')
+    return None